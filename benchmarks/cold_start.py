@@ -0,0 +1,88 @@
+"""Cold start import benchmark for the notifier lambda.
+
+Imports the handler module in fresh interpreters with `python -X importtime`
+and reports the median self and cumulative import time of every module that
+the function code or its dependencies load, plus the wall time of the import.
+
+    $ python benchmarks/cold_start.py --runs 10 --top 25
+
+Runs against the interpreter it is started with, so install src/requirements.txt
+and boto3 (provided by the lambda runtime) first.
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+from collections import defaultdict
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src')
+
+# module level code reads these, and boto3 needs a region to create clients
+ENVIRONMENT = {
+    'AWS_DEFAULT_REGION': 'ap-northeast-2',
+    'DYNAMODB_TABLE': 'codepipeline-slack-integration',
+    'METRICS_ENABLED': 'False',
+}
+
+
+def import_once(module):
+    env = dict(os.environ, **ENVIRONMENT)
+    started_at = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=SRC_DIR, env=env, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True,
+    )
+    wall_ms = (time.perf_counter() - started_at) * 1000
+    if result.returncode != 0:
+        raise RuntimeError(f'import {module} failed\n{result.stderr}')
+
+    return wall_ms, parse_importtime(result.stderr)
+
+
+def parse_importtime(output):
+    # import time: self [us] | cumulative | imported package
+    timings = dict()
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        timings[name.strip()] = (int(self_us), int(cumulative_us))
+
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='notifier')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+
+    walls = []
+    self_times = defaultdict(list)
+    cumulative_times = defaultdict(list)
+    for _ in range(args.runs):
+        wall_ms, timings = import_once(args.module)
+        walls.append(wall_ms)
+        for name, (self_us, cumulative_us) in timings.items():
+            self_times[name].append(self_us)
+            cumulative_times[name].append(cumulative_us)
+
+    rows = sorted(
+        ((statistics.median(cumulative_times[name]), statistics.median(self_times[name]), name) for name in cumulative_times),
+        reverse=True,
+    )
+
+    print(f'import {args.module}: {args.runs} runs, interpreter start + import wall time '
+          f'p50 {statistics.median(walls):.1f} ms, max {max(walls):.1f} ms')
+    print(f'{"cumulative ms":>14} {"self ms":>9}  module')
+    for cumulative_us, self_us, name in rows[:args.top]:
+        print(f'{cumulative_us / 1000:>14.1f} {self_us / 1000:>9.1f}  {name}')
+
+    print(f'{len(rows)} modules imported')
+
+
+if __name__ == '__main__':
+    main()
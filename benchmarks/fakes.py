@@ -0,0 +1,158 @@
+"""Local stand-ins for the services the notifier talks to during a replay.
+
+FakeApiServer answers the Slack Web API and GitHub API calls the function makes
+on a loopback port. FakeCodePipeline replaces the boto3 codepipeline client with
+responses consistent with the recorded corpus, FakeCodeBuild and FakeLogs the clients
+that read the log of a failed build. DynamoDB and SQS are served by moto.
+"""
+import json
+import threading
+from urllib.parse import urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PIPELINE_NAME = 'sample-service'
+REPOSITORY = 'sample-org/sample-service'
+BRANCH = 'main'
+COMMIT = '7f3c2a9e1b4d6f8a0c2e4b6d8f0a1c3e5b7d9f1a'
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    # keep-alive like the real apis, so connection reuse in the clients is part of the measurement
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.dispatch({})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.dispatch(json.loads(self.rfile.read(length) or '{}'))
+
+    def dispatch(self, body):
+        path = urlparse(self.path).path
+        self.server.count(path)
+        if path.startswith('/slack/'):
+            self.respond(self.server.slack_response(path[len('/slack/'):], body))
+        elif path.startswith('/github/repos/'):
+            self.respond({'commit': {'author': {'name': 'Sample Developer'}}})
+        else:
+            self.respond({'message': 'Not Found'}, status=404)
+
+    def respond(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, channel_names):
+        super().__init__(('127.0.0.1', 0), FakeApiHandler)
+        self.channels = [{'id': f'C0BENCH{index:03d}', 'name': name} for index, name in enumerate(channel_names)]
+        self.requests = dict()
+        self._lock = threading.Lock()
+        self._ts = 0
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def count(self, path):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def slack_response(self, method, body):
+        if method == 'conversations.list':
+            return {'ok': True, 'channels': self.channels}
+        if method == 'chat.postMessage':
+            with self._lock:
+                self._ts += 1
+                return {'ok': True, 'channel': body.get('channel'), 'ts': f'1647248400.{self._ts:06d}'}
+        if method in ('chat.update', 'chat.delete'):
+            return {'ok': True, 'channel': body.get('channel'), 'ts': body.get('ts')}
+        return {'ok': False, 'error': 'unknown_method'}
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class FakeCodePipeline:
+    # the pipeline of the corpus. list_action_executions reports the build of the run being replayed
+    def __init__(self):
+        self.latest_execution_id = None
+        self.latest_build_key = None
+
+    def list_pipelines(self, **kwargs):
+        return {'pipelines': [{'name': PIPELINE_NAME}]}
+
+    def get_pipeline(self, name):
+        return {'pipeline': {'name': name, 'stages': [
+            {'name': 'Source', 'actions': [{
+                'name': 'Source',
+                'configuration': {'FullRepositoryId': REPOSITORY, 'BranchName': BRANCH},
+            }]},
+            {'name': 'Build', 'actions': [{'name': 'Build', 'configuration': {'ProjectName': f'{name}-build'}}]},
+            {'name': 'Deploy', 'actions': [{'name': 'Deploy', 'configuration': {}}]},
+        ]}}
+
+    def get_pipeline_execution(self, pipelineName, pipelineExecutionId):
+        return {'pipelineExecution': {
+            'pipelineName': pipelineName,
+            'pipelineExecutionId': pipelineExecutionId,
+            'artifactRevisions': [{
+                'name': 'Source',
+                'revisionId': COMMIT,
+                'revisionSummary': json.dumps({'ProviderType': 'GitHub', 'CommitMessage': 'Fix retry on slack 429'}),
+                'revisionUrl': f'https://console.aws.amazon.com/codesuite/settings/connections/redirect'
+                               f'?FullRepositoryId={REPOSITORY}&Commit={COMMIT}',
+            }],
+        }}
+
+    def list_action_executions(self, pipelineName, **kwargs):
+        # the build action of the run being replayed, in progress like the first phase events see it
+        return {'actionExecutionDetails': [{
+            'pipelineExecutionId': self.latest_execution_id,
+            'stageName': 'Build',
+            'actionName': 'Build',
+            'status': 'InProgress',
+            'output': {'executionResult': {
+                'externalExecutionId': self.latest_build_key,
+                'externalExecutionUrl': f'https://console.aws.amazon.com/codebuild/home#/builds/{self.latest_build_key}',
+            }},
+        }]}
+
+
+class FakeCodeBuild:
+    def batch_get_builds(self, ids):
+        return {'builds': [
+            {'id': build_id, 'logs': {'groupName': f'/aws/codebuild/{build_id.split(":")[0].split("/")[-1]}',
+                                      'streamName': build_id.split(':')[-1]}}
+            for build_id in ids
+        ]}
+
+
+class FakeLogs:
+    # a build log of LOG_LINES lines failing near the end, paged like get_log_events
+    LOG_LINES = 2000
+    ERROR_LINE = 1940
+
+    def __init__(self):
+        self.lines = [f'[Container] 2022/03/14 09:02:{index % 60:02d} step {index}: ok\n' for index in range(self.LOG_LINES)]
+        self.lines[self.ERROR_LINE] = 'npm ERR! Test failed.  See above for more details.\n'
+
+    def get_log_events(self, logGroupName, logStreamName, startFromHead, limit, nextToken=None):
+        # tokens are the index the page ends at
+        end = int(nextToken[2:]) if nextToken else len(self.lines)
+        start = max(end - limit, 0)
+        return {
+            'events': [{'timestamp': index, 'message': self.lines[index]} for index in range(start, end)],
+            'nextBackwardToken': f'b/{start}',
+            'nextForwardToken': f'f/{end}',
+        }
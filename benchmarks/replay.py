@@ -0,0 +1,300 @@
+"""Replays recorded EventBridge events through notifier.run against local stand-ins.
+
+Every run of the corpus gets fresh execution, build and deployment ids, and the
+events are delivered as SQS batches of SNS notifications like in production.
+Slack and GitHub are served by a loopback http server, CodePipeline by an
+in-process fake, and DynamoDB and SQS by moto.
+
+Reports per handler latency, the api calls made per event type (from the
+latency metrics every external call emits), and with --allocations the memory
+allocated per handler and by source file, measured in a separate pass with
+tracemalloc so that it does not skew the latency numbers.
+
+    $ pip install -r benchmarks/requirements.txt
+    $ python benchmarks/replay.py --runs 20 --allocations
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+import tracemalloc
+from collections import defaultdict, Counter
+
+from fakes import FakeApiServer, FakeCodePipeline, FakeCodeBuild, FakeLogs
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.normpath(os.path.join(BENCHMARK_DIR, os.pardir, 'src'))
+CORPUS = os.path.join(BENCHMARK_DIR, 'events')
+RUN_PLACEHOLDER = '__RUN__'
+
+SLACK_CHANNEL = 'benchmark'
+# routed to by rules in SLACK_ROUTES when set in the environment of the replay
+SLACK_CHANNELS = (SLACK_CHANNEL, 'benchmark-alert', 'benchmark-deploy')
+DYNAMODB_TABLES = {
+    'DYNAMODB_TABLE': ('codepipeline-slack-integration', 'deployment_id'),
+    'DYNAMODB_EXECUTION_TABLE': ('codepipeline-slack-executions', 'pipeline_execution_id'),
+    'DYNAMODB_CACHE_TABLE': ('codepipeline-slack-cache', 'cache_key'),
+    'DYNAMODB_ALARM_TABLE': ('codepipeline-slack-alarms', 'alarm_key'),
+    'DYNAMODB_RUN_TABLE': ('codepipeline-slack-runs', 'pipeline_name', 'sk'),
+}
+
+
+class Recorder:
+    # collects timings and api calls of the handler or post currently running
+    def __init__(self):
+        self.current = None
+        self.latencies = defaultdict(list)
+        self.peaks = defaultdict(list)
+        self.calls = defaultdict(Counter)
+        self.allocations = False
+
+    def on_emit(self, metric_name, value, unit='Milliseconds', **dimensions):
+        if metric_name == 'Latency' and self.current is not None and not self.allocations:
+            self.calls[self.current][dimensions['operation']] += 1
+
+    def measure(self, name, func, *args, **kwargs):
+        previous, self.current = self.current, name
+        if self.allocations:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        started_at = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            # the allocation pass only adds peaks, tracing would skew the latencies
+            if self.allocations:
+                self.peaks[name].append(tracemalloc.get_traced_memory()[1] - before)
+            else:
+                self.latencies[name].append((time.perf_counter() - started_at) * 1000)
+            self.current = previous
+
+
+def install(recorder, notifier, metrics):
+    process_event, post_message = notifier.process_event, notifier.post_message
+
+    def recorded_process_event(event, batch):
+        name = type(event).__name__
+        return recorder.measure(name, process_event, event, batch)
+
+    def recorded_post_message(message_builder, **kwargs):
+        return recorder.measure('post_message', post_message, message_builder, **kwargs)
+
+    notifier.process_event = recorded_process_event
+    notifier.post_message = recorded_post_message
+    metrics.emit = recorder.on_emit
+
+
+def configure_environment(server, use_async):
+    os.environ.update({
+        'AWS_DEFAULT_REGION': 'ap-northeast-2',
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing',
+        'SLACK_BOT_TOKEN': 'xoxb-benchmark',
+        'SLACK_CHANNEL': SLACK_CHANNEL,
+        'SLACK_API_URL': server.url + '/slack/',
+        'GITHUB_API_URL': server.url + '/github',
+        'GITHUB_ACCESS_TOKEN': 'benchmark',
+        'SHOW_BUILD_PHASE': 'True',
+        'SHOW_DURATIONS': 'True',
+        'SHOW_BUILD_LOG': 'True',
+        'ASYNC_MODE': str(use_async),
+    })
+    for variable, (table_name, *_) in DYNAMODB_TABLES.items():
+        os.environ[variable] = table_name
+
+
+def create_aws_resources():
+    import boto3
+
+    dynamodb = boto3.client('dynamodb')
+    for table_name, *keys in DYNAMODB_TABLES.values():
+        dynamodb.create_table(
+            TableName=table_name,
+            KeySchema=[{'AttributeName': key, 'KeyType': key_type} for key, key_type in zip(keys, ('HASH', 'RANGE'))],
+            AttributeDefinitions=[{'AttributeName': key, 'AttributeType': 'S'} for key in keys],
+            BillingMode='PAY_PER_REQUEST',
+        )
+
+    os.environ['SQS_QUEUE_URL'] = boto3.client('sqs').create_queue(QueueName='codepipeline-slack-queue')['QueueUrl']
+
+
+def load_corpus(path):
+    corpus = []
+    for file_name in sorted(os.listdir(path)):
+        if file_name.endswith('.json'):
+            with open(os.path.join(path, file_name)) as f:
+                corpus.append(f.read())
+    return corpus
+
+
+def render_run(corpus, run):
+    # recorded ids carry a placeholder, so every run is a new pipeline execution per recording
+    return [json.loads(recording.replace(RUN_PLACEHOLDER, f'{run:08x}')) for recording in corpus]
+
+
+def to_sqs_message(events):
+    return {'Records': [
+        {
+            'messageId': f'{event["id"]}-{index}',
+            'body': json.dumps({'Type': 'Notification', 'Message': json.dumps(event)}),
+            'attributes': {},
+        }
+        for index, event in enumerate(events)
+    ]}
+
+
+def point_fake_pipeline(codepipeline, events):
+    # list_action_executions reports the execution and build being replayed
+    for event in events:
+        if event['source'] == 'aws.codepipeline' and codepipeline.latest_execution_id is None:
+            codepipeline.latest_execution_id = event['detail']['execution-id']
+        if event['source'] == 'aws.codebuild':
+            codepipeline.latest_build_key = event['detail']['build-id'].split('/')[-1]
+
+
+def replay(notifier, codepipeline, corpus, runs, batch_size, shuffle, first_run=0):
+    failures = 0
+    started_at = time.perf_counter()
+    for run in range(first_run, first_run + runs):
+        for events in render_run(corpus, run):
+            codepipeline.latest_execution_id = None
+            point_fake_pipeline(codepipeline, events)
+            for index in range(0, len(events), batch_size):
+                batch = events[index:index + batch_size]
+                if shuffle:
+                    # standard queues do not keep the order within a batch
+                    random.shuffle(batch)
+                failures += len(notifier.run(to_sqs_message(batch), None)['batchItemFailures'])
+
+    return (time.perf_counter() - started_at) * 1000, failures
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def report(recorder, http_requests, total_ms, failures, runs, allocation_stats):
+    result = {
+        'total_ms': round(total_ms, 1),
+        'runs': runs,
+        'failures': failures,
+        'handlers': {},
+        'http_requests': dict(sorted(http_requests.items())),
+    }
+
+    print(f'replayed {runs} runs in {total_ms:.0f} ms, {failures} batch item failures')
+    print()
+    print(f'{"handler":<16} {"count":>6} {"p50 ms":>8} {"p95 ms":>8} {"max ms":>8} {"peak KiB":>9}  api calls per call')
+    for name in sorted(recorder.latencies):
+        latencies = recorder.latencies[name]
+        calls = {operation: round(count / len(latencies), 2) for operation, count in sorted(recorder.calls[name].items())}
+        peak = statistics.median(recorder.peaks[name]) / 1024 if recorder.peaks[name] else None
+        result['handlers'][name] = {
+            'count': len(latencies),
+            'p50_ms': round(statistics.median(latencies), 2),
+            'p95_ms': round(percentile(latencies, 95), 2),
+            'max_ms': round(max(latencies), 2),
+            'peak_kib': None if peak is None else round(peak, 1),
+            'api_calls': calls,
+        }
+        print(f'{name:<16} {len(latencies):>6} {statistics.median(latencies):>8.2f} {percentile(latencies, 95):>8.2f} '
+              f'{max(latencies):>8.2f} {"-" if peak is None else f"{peak:.1f}":>9}  '
+              + ', '.join(f'{operation} {count:g}' for operation, count in calls.items()))
+
+    print()
+    print('http requests: ' + ', '.join(f'{path} {count}' for path, count in result['http_requests'].items()))
+
+    if allocation_stats:
+        result['allocations'] = allocation_stats
+        print()
+        print(f'{"allocated KiB":>14} {"blocks":>8}  source file (retained after the replay)')
+        for stat in allocation_stats:
+            print(f'{stat["size_kib"]:>14.1f} {stat["count"]:>8}  {stat["file"]}')
+
+    return result
+
+
+def measure_allocations(recorder, notifier, codepipeline, corpus, runs, batch_size, shuffle):
+    recorder.allocations = True
+    recorder.peaks.clear()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    # new executions again, so the pass posts and updates messages like the measured one
+    replay(notifier, codepipeline, corpus, runs, batch_size, shuffle, first_run=runs)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    recorder.allocations = False
+
+    source_filter = tracemalloc.Filter(True, os.path.join(SRC_DIR, '*'))
+    stats = after.filter_traces([source_filter]).compare_to(before.filter_traces([source_filter]), 'filename')
+    return [
+        {'file': os.path.relpath(stat.traceback[0].filename, SRC_DIR), 'size_kib': round(stat.size_diff / 1024, 1),
+         'count': stat.count_diff}
+        for stat in stats if stat.size_diff > 0
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--corpus', default=CORPUS, help='directory of recorded event lists (json)')
+    parser.add_argument('--runs', type=int, default=10, help='replays of the corpus, each as new executions')
+    parser.add_argument('--batch-size', type=int, default=10)
+    parser.add_argument('--shuffle', action='store_true', help='shuffle the records of every batch')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--async', dest='use_async', action='store_true', help='replay with ASYNC_MODE=True')
+    parser.add_argument('--allocations', action='store_true', help='trace allocations in a second pass')
+    parser.add_argument('--json', help='write the results to this file, to compare revisions')
+    args = parser.parse_args()
+
+    from moto import mock_aws
+
+    random.seed(args.seed)
+    server = FakeApiServer(SLACK_CHANNELS).start()
+    configure_environment(server, args.use_async)
+
+    with mock_aws():
+        create_aws_resources()
+
+        # imported once the environment points at the stand-ins, like a cold start
+        sys.path.insert(0, SRC_DIR)
+        import notifier
+        import metrics
+        import aws_client
+        import build_log
+        import slack_client
+
+        # the fake slack api has no rate limit tiers to respect
+        slack_client.RATE_LIMITS = dict.fromkeys(slack_client.RATE_LIMITS, 10 ** 6)
+        slack_client.DEFAULT_RATE_LIMIT = 10 ** 6
+
+        codepipeline = FakeCodePipeline()
+        aws_client.client = codepipeline
+        build_log.codebuild = FakeCodeBuild()
+        build_log.logs = FakeLogs()
+
+        recorder = Recorder()
+        install(recorder, notifier, metrics)
+        corpus = load_corpus(args.corpus)
+
+        total_ms, failures = replay(notifier, codepipeline, corpus, args.runs, args.batch_size, args.shuffle)
+        http_requests = dict(server.requests)
+        allocation_stats = None
+        if args.allocations:
+            allocation_stats = measure_allocations(
+                recorder, notifier, codepipeline, corpus, args.runs, args.batch_size, args.shuffle
+            )
+
+    result = report(recorder, http_requests, total_ms, failures, args.runs, allocation_stats)
+    server.shutdown()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
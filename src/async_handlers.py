@@ -0,0 +1,141 @@
+import asyncio
+
+from event_parser import (
+    PipelineEvent,
+    StageEvent,
+    ActionEvent,
+    BuildEvent,
+    DeployEvent,
+)
+from dynamodb_helper import (
+    find_or_create_item,
+    update_item,
+    find_execution,
+)
+from message_builder import MessageBuilder
+from aws_client import (
+    find_revision_info,
+    find_pipeline_from_build,
+    find_pipeline_schema,
+    get_pipeline,
+    get_pipeline_execution,
+)
+from slack_helper import (
+    find_channel_id,
+    SLACK_CHANNEL,
+)
+from notifier import index_action_build, attach_build_log
+from log_helper import bind
+import async_io
+
+# asyncio variants of the notifier handlers, used with ASYNC_MODE
+# the same updates are applied to the message builder, only the lookups that do not depend on each other are awaited together
+
+async def get_message_builder_async(batch, pipeline_execution_id, pipeline_name):
+    if pipeline_execution_id in batch:
+        return batch[pipeline_execution_id]['message_builder']
+
+    item = await async_io.run_blocking(find_execution, pipeline_execution_id)
+    return MessageBuilder(item, pipeline_execution_id, pipeline_name)
+
+
+async def process_code_pipeline_async(event, batch):
+    pipeline_execution_id, pipeline_name = event.pipeline_execution_id, event.pipeline_name
+    is_deployment = isinstance(event, ActionEvent) and event.is_deployment()
+
+    # aws lookups are memoized or cached, so the ones the builder is about to make are prefetched
+    # along with the execution state, and the channel id of a possible first message is warmed
+    lookups = [get_message_builder_async(batch, pipeline_execution_id, pipeline_name)]
+    if pipeline_execution_id not in batch:
+        lookups.append(async_io.run_blocking(find_channel_id, SLACK_CHANNEL))
+    if isinstance(event, StageEvent) and event.stage == 'Source' and event.state == 'SUCCEEDED':
+        # github info. the pipeline schema is then read from the memoized get_pipeline response
+        lookups.append(async_io.run_blocking(get_pipeline, pipeline_name))
+        lookups.append(async_io.run_blocking(get_pipeline_execution, pipeline_execution_id, pipeline_name))
+    elif isinstance(event, StageEvent):
+        lookups.append(async_io.run_blocking(find_pipeline_schema, pipeline_name))
+    if isinstance(event, ActionEvent) and event.is_build():
+        lookups.append(async_io.run_blocking(index_action_build, event))
+    if is_deployment:
+        lookups.append(async_io.run_blocking(
+            find_or_create_item, deployment_id=event.external_execution_id, pipeline_id=pipeline_execution_id
+        ))
+    results = await asyncio.gather(*lookups)
+    message_builder = results[0]
+
+    message_builder.update_pipeline_message(event=event)
+
+    if message_builder.has_revision_info_field():
+        revision_info = await async_io.run_blocking(find_revision_info, pipeline_execution_id, pipeline_name)
+        message_builder.attach_revision_info(revision_info)
+
+    if is_deployment:
+        item = results[-1]
+        if item:
+            await async_io.run_blocking(
+                update_item, deployment_id=event.external_execution_id, pipeline_id=pipeline_execution_id
+            )
+            message_builder.update_deploy_task_definition(item.get('task_def'))
+        else:
+            return None
+
+    return message_builder
+
+
+async def process_code_build_async(event, batch):
+    if event.pipeline_name is None:
+        return None
+
+    # the execution state is keyed by the execution id this lookup returns, so nothing runs alongside it
+    stage_name, pipeline_execution_id, build_url = await async_io.run_blocking(
+        find_pipeline_from_build, event.pipeline_name, event.build_id
+    )
+
+    if not pipeline_execution_id:
+        return None
+
+    bind(pipeline_execution_id=pipeline_execution_id)
+    message_builder = await get_message_builder_async(batch, pipeline_execution_id, event.pipeline_name)
+
+    if event.phases is not None:
+        message_builder.update_build_stage_info(
+            stage_name, event.phases, build_url, event.project_name, event_time=event.time
+        )
+
+    if message_builder.failed_build is not None:
+        await async_io.run_blocking(attach_build_log, message_builder, event)
+
+    return message_builder
+
+
+async def process_code_deploy_async(event, batch):
+    deployment_id, task_def = event.deployment_id, event.task_def
+    item = await async_io.run_blocking(find_or_create_item, deployment_id=deployment_id, task_def=task_def)
+    if not item:
+        return None
+
+    pipeline_id = item.get('pipeline_id')
+    if pipeline_id is None:
+        await async_io.run_blocking(update_item, deployment_id=deployment_id, task_def=task_def)
+        return None
+
+    bind(pipeline_execution_id=pipeline_id)
+    _, message_builder = await asyncio.gather(
+        async_io.run_blocking(update_item, deployment_id=deployment_id, task_def=task_def),
+        get_message_builder_async(batch, pipeline_id, None),
+    )
+    # the pipeline name is only known once the execution has a message
+    if not message_builder.has_message():
+        return None
+
+    message_builder.update_deploy_task_definition(task_def)
+    return message_builder
+
+
+ASYNC_HANDLERS = {
+    PipelineEvent: process_code_pipeline_async,
+    StageEvent: process_code_pipeline_async,
+    ActionEvent: process_code_pipeline_async,
+    BuildEvent: process_code_build_async,
+    DeployEvent: process_code_deploy_async,
+}
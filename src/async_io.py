@@ -0,0 +1,21 @@
+import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+# boto3 and requests are blocking, so coroutines hand their calls to a thread pool
+# and await independent calls together instead of one after another
+ASYNC_IO_MAX_WORKERS = int(os.getenv('ASYNC_IO_MAX_WORKERS', 8))
+
+executor = ThreadPoolExecutor(max_workers=ASYNC_IO_MAX_WORKERS)
+
+# created once per container, like the api clients
+loop = asyncio.new_event_loop()
+
+
+async def run_blocking(func, *args, **kwargs):
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+def run(coroutine):
+    return loop.run_until_complete(coroutine)
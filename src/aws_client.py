@@ -1,37 +1,183 @@
-import boto3
-client = boto3.client('codepipeline')
+import os
+import json
+import logging
+from cache import TTLCache, cached, MISSING
+from lazy import lazy_client
+from dynamodb_helper import find_cache_items, put_cache_items
+from metrics import timer, timed
 
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
 
-def find_revision_info(pipeline_execution_id, pipeline_name):
-    res = client.get_pipeline_execution(
+client = lazy_client('codepipeline')
+sqs = lazy_client('sqs')
+
+SQS_QUEUE_URL = os.getenv('SQS_QUEUE_URL')
+# records of a fifo queue are grouped by pipeline execution id (MessageGroupId)
+SQS_FIFO_MODE = os.getenv('SQS_FIFO_MODE') == 'True'
+
+PIPELINE_SCHEMA_CACHE_TTL = int(os.getenv('PIPELINE_SCHEMA_CACHE_TTL', 300))
+
+pipeline_schema_cache = TTLCache('pipeline_schema', ttl=PIPELINE_SCHEMA_CACHE_TTL, max_size=256)
+
+# codebuild build ('project:uuid') -> the pipeline execution, stage and action that started it
+# a build always belongs to the same action execution, so entries only expire to keep the table small
+BUILD_CORRELATION_TTL_DAYS = int(os.getenv('BUILD_CORRELATION_TTL_DAYS', 7))
+
+build_correlation_cache = TTLCache('build_correlation', ttl=BUILD_CORRELATION_TTL_DAYS * 24 * 60 * 60, max_size=1024)
+# builds missing from the index are looked up in the latest action executions of their pipeline
+ACTION_EXECUTION_PAGE_SIZE = int(os.getenv('ACTION_EXECUTION_PAGE_SIZE', 100))
+ACTION_EXECUTION_MAX_PAGES = int(os.getenv('ACTION_EXECUTION_MAX_PAGES', 2))
+
+
+# codepipeline responses memoized for the current invocation, keyed by (operation, args)
+# reset by the notifier at the start of every invocation
+request_context = dict()
+
+
+def reset_request_context():
+    request_context.clear()
+
+
+def call(operation, **kwargs):
+    key = (operation, tuple(sorted(kwargs.items())))
+    if key not in request_context:
+        with timer(f'codepipeline.{operation}'):
+            request_context[key] = getattr(client, operation)(**kwargs)
+    return request_context[key]
+
+
+def get_pipeline(pipeline_name):
+    return call('get_pipeline', name=pipeline_name)
+
+
+def get_pipeline_execution(pipeline_execution_id, pipeline_name):
+    return call(
+        'get_pipeline_execution',
         pipelineName=pipeline_name,
         pipelineExecutionId=pipeline_execution_id
-    )['pipelineExecution']
+    )
+
+
+def list_pipeline_names():
+    kwargs = dict()
+    while True:
+        with timer('codepipeline.list_pipelines'):
+            res = client.list_pipelines(**kwargs)
+        for pipeline in res['pipelines']:
+            yield pipeline['name']
+
+        if 'nextToken' not in res:
+            return
+        kwargs['nextToken'] = res['nextToken']
+
+
+def find_revision_info(pipeline_execution_id, pipeline_name):
+    res = get_pipeline_execution(pipeline_execution_id, pipeline_name)['pipelineExecution']
 
     if 'artifactRevisions' in res:
-        return res[0]
+        return res['artifactRevisions'][0]
     else:
         return None
 
 
 def find_pipeline_from_build(pipeline_name, build_id):
-    res = client.get_pipeline_state(
-        name=pipeline_name
-    )['stageStates']
+    # returns (stage name, pipeline execution id, build url)
+    build_key = build_correlation_key(build_id)
+    correlation = find_build_correlation(build_key)
+    if correlation is None:
+        # not indexed yet. action events only carry the build once it has ended, so this is
+        # how the phase events of a running build are resolved, and then indexed
+        correlation = find_build_correlation_from_action_executions(pipeline_name, build_key)
+        if correlation is None:
+            return None, None, None
+        index_build(build_id, **correlation)
+
+    return correlation['stage_name'], correlation['pipeline_execution_id'], correlation['build_url']
+
+
+def find_build_correlation(build_key):
+    correlation = build_correlation_cache.get(build_key)
+    if correlation is not MISSING:
+        return correlation
+
+    try:
+        correlation = find_cache_items([build_cache_key(build_key)]).get(build_cache_key(build_key))
+    except Exception:
+        logger.exception('error while reading build correlation index.')
+        return None
+
+    if correlation is not None:
+        build_correlation_cache.set(build_key, correlation)
+    return correlation
+
+
+def find_build_correlation_from_action_executions(pipeline_name, build_key):
+    # action executions of every pipeline execution, newest first. in progress actions already carry
+    # the external execution id, so superseded and retried builds resolve to the execution that started them
+    kwargs = {'pipelineName': pipeline_name, 'maxResults': ACTION_EXECUTION_PAGE_SIZE}
+    for _ in range(ACTION_EXECUTION_MAX_PAGES):
+        with timer('codepipeline.list_action_executions'):
+            res = client.list_action_executions(**kwargs)
 
-    for stage_state in res:
-        for action_state in stage_state['actionStates']:
-            execution_id = action_state['latestExecution']['externalExecutionId']
-            if execution_id and build_id.endswith(execution_id):
-                pipeline_execution_id = stage_state['latestExecution']['pipelineExecutionId']
-                stage_name = stage_state['stageName']
+        for action_execution in res['actionExecutionDetails']:
+            execution_result = action_execution.get('output', {}).get('executionResult', {})
+            if execution_result.get('externalExecutionId') == build_key:
+                return {
+                    'pipeline_execution_id': action_execution['pipelineExecutionId'],
+                    'stage_name': action_execution['stageName'],
+                    'action_name': action_execution['actionName'],
+                    'build_url': execution_result.get('externalExecutionUrl'),
+                }
 
-                return stage_name, pipeline_execution_id, action_state
+        if 'nextToken' not in res:
+            return None
+        kwargs['nextToken'] = res['nextToken']
 
-    return None, None, None
+    return None
 
 
+def index_build(build_id, pipeline_execution_id, stage_name, action_name, build_url):
+    build_key = build_correlation_key(build_id)
+    correlation = {
+        'pipeline_execution_id': pipeline_execution_id,
+        'stage_name': stage_name,
+        'action_name': action_name,
+        'build_url': build_url,
+    }
+    if build_correlation_cache.get(build_key) == correlation:
+        return
+
+    build_correlation_cache.set(build_key, correlation)
+    try:
+        put_cache_items({build_cache_key(build_key): correlation}, ttl_days=BUILD_CORRELATION_TTL_DAYS)
+    except Exception:
+        logger.exception('error while writing build correlation index.')
+
+
+def build_correlation_key(build_id):
+    # build arn (arn:aws:codebuild:region:account:build/project:uuid) or the codepipeline external execution id
+    return build_id.split('/')[-1]
+
+
+def build_cache_key(build_key):
+    return f'build#{build_key}'
+
+
+@cached(pipeline_schema_cache)
 def find_pipeline_schema(pipeline_name):
-    res = client.get_pipeline(name=pipeline_name)
+    res = get_pipeline(pipeline_name)
     schema = [stage['name'] for stage in res['pipeline']['stages']]
     return schema
+
+
+@timed('sqs.send_message')
+def enqueue_message(event, delay_seconds=0, group_id=None):
+    # sent as a raw eventbridge-like event, which the notifier reads like any other record
+    kwargs = {'QueueUrl': SQS_QUEUE_URL, 'MessageBody': json.dumps(event)}
+    if SQS_FIFO_MODE:
+        # fifo queues reject per message delays, the message is delivered in order within its group instead
+        kwargs.update(MessageGroupId=group_id or event['id'], MessageDeduplicationId=event['id'])
+    else:
+        kwargs['DelaySeconds'] = delay_seconds
+    sqs.send_message(**kwargs)
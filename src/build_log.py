@@ -0,0 +1,83 @@
+import os
+import re
+import logging
+from lazy import lazy_client
+from metrics import timer, timed
+
+codebuild = lazy_client('codebuild')
+logs = lazy_client('logs')
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# the excerpt is read from the end of the log stream, at most BUILD_LOG_PAGE_SIZE * BUILD_LOG_MAX_PAGES lines
+BUILD_LOG_PAGE_SIZE = int(os.getenv('BUILD_LOG_PAGE_SIZE', 100))
+BUILD_LOG_MAX_PAGES = int(os.getenv('BUILD_LOG_MAX_PAGES', 3))
+# the excerpt starts a few lines before the first line matching the pattern in what was read,
+# or is the last lines of the log when nothing matches
+BUILD_LOG_ERROR_PATTERN = re.compile(os.getenv('BUILD_LOG_ERROR_PATTERN', r'(?i)\b(error|exception|fatal|failed)\b'))
+BUILD_LOG_CONTEXT_LINES = int(os.getenv('BUILD_LOG_CONTEXT_LINES', 3))
+BUILD_LOG_EXCERPT_LINES = int(os.getenv('BUILD_LOG_EXCERPT_LINES', 20))
+BUILD_LOG_EXCERPT_LIMIT = int(os.getenv('BUILD_LOG_EXCERPT_LIMIT', 1500))
+TRUNCATION_MARK = '…'
+
+
+@timed('codebuild.batch_get_builds')
+def find_log_location(build_id):
+    builds = codebuild.batch_get_builds(ids=[build_id])['builds']
+    log_info = builds[0].get('logs', {}) if builds else {}
+    if not log_info.get('groupName') or not log_info.get('streamName'):
+        return None
+    return log_info['groupName'], log_info['streamName']
+
+
+def read_log_tail(log_group, log_stream):
+    # pages from the end of the stream backwards, each page oldest line first
+    kwargs = {
+        'logGroupName': log_group,
+        'logStreamName': log_stream,
+        'startFromHead': False,
+        'limit': BUILD_LOG_PAGE_SIZE,
+    }
+    for _ in range(BUILD_LOG_MAX_PAGES):
+        with timer('logs.get_log_events'):
+            res = logs.get_log_events(**kwargs)
+        if not res['events']:
+            return
+        yield [event['message'].rstrip('\n') for event in res['events']]
+
+        # the start of the stream returns the token it was called with
+        if res.get('nextBackwardToken') in (None, kwargs.get('nextToken')):
+            return
+        kwargs['nextToken'] = res['nextBackwardToken']
+
+
+def find_build_log_excerpt(build_id, log_location=None):
+    # a log that can not be read (throttled, deleted, or in a log group the function may not read)
+    # never fails the record. the failure is reported without an excerpt and the log is not read again
+    try:
+        return read_build_log_excerpt(build_id, log_location)
+    except Exception:
+        logger.exception(f'error while reading build log. build id: {build_id}')
+        return None
+
+
+def read_build_log_excerpt(build_id, log_location):
+    # build state events carry the log stream, phase events usually do not
+    log_location = log_location or find_log_location(build_id)
+    if log_location is None:
+        return None
+
+    pages = list(read_log_tail(*log_location))
+    lines = [line for page in reversed(pages) for line in page]
+    error_index = next((index for index, line in enumerate(lines) if BUILD_LOG_ERROR_PATTERN.search(line)), None)
+    if error_index is None:
+        excerpt = lines[-BUILD_LOG_EXCERPT_LINES:]
+    else:
+        start = max(error_index - BUILD_LOG_CONTEXT_LINES, 0)
+        excerpt = lines[start:start + BUILD_LOG_EXCERPT_LINES]
+
+    excerpt = '\n'.join(excerpt)
+    if len(excerpt) > BUILD_LOG_EXCERPT_LIMIT:
+        excerpt = excerpt[:BUILD_LOG_EXCERPT_LIMIT - len(TRUNCATION_MARK)] + TRUNCATION_MARK
+    return excerpt
@@ -0,0 +1,79 @@
+import time
+import threading
+import functools
+from collections import OrderedDict
+
+# caches live at module level so they survive between invocations of a warm lambda container
+CACHES = []
+
+MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, name, ttl, max_size=128):
+        self.name = name
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        CACHES.append(self)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self._items.pop(key, None)
+                self.misses += 1
+                return MISSING
+
+            self._items.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, key=MISSING):
+        with self._lock:
+            if key is MISSING:
+                self._items.clear()
+            else:
+                self._items.pop(key, None)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._items)}
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+
+def cached(cache):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            value = cache.get(args)
+            if value is MISSING:
+                value = func(*args)
+                cache.set(args, value)
+            return value
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
+
+
+def cache_stats():
+    return {cache.name: cache.stats() for cache in CACHES}
+
+
+def reset_cache_stats():
+    for cache in CACHES:
+        cache.reset_stats()
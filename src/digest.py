@@ -0,0 +1,170 @@
+import os
+import heapq
+from datetime import datetime, timedelta, timezone
+from collections import Counter, OrderedDict
+
+from aws_client import list_pipeline_names
+from dynamodb_helper import query_runs
+from slack_helper import (
+    find_channel_id,
+    send_message,
+)
+from routing import find_channels
+from run_analytics import format_duration
+from event_parser import EVENT_TIME_FORMAT
+from log_helper import (
+    bind,
+    clear,
+    log,
+)
+
+# entry point of the scheduled digest. every routed channel gets one message about the runs
+# of its pipelines that ended in the last DIGEST_PERIOD_HOURS (or "period_hours" of the schedule input)
+DIGEST_PERIOD_HOURS = int(os.getenv('DIGEST_PERIOD_HOURS', 24))
+DIGEST_PAGE_SIZE = int(os.getenv('DIGEST_PAGE_SIZE', 100))
+# lines per section of the message
+DIGEST_TOP_ITEMS = int(os.getenv('DIGEST_TOP_ITEMS', 5))
+
+# channels are found like the ones of the executions, without a state
+DIGEST_EVENT_SOURCES = ('aws.codepipeline',)
+RUN_ATTRIBUTES = ('state', 'duration', 'stages', 'builds', 'task_def')
+
+STATE_ICONS = {
+    'SUCCEEDED': ":white_check_mark:",
+    'FAILED': ":x:",
+}
+
+
+class Digest:
+    # aggregates runs as they are streamed. the size depends on the pipelines, stages and builds
+    # of the channel, never on the number of runs
+    __slots__ = ('states', 'failures', 'stages', 'builds', 'deployments', 'deployment_count')
+
+    def __init__(self):
+        self.states = Counter()
+        # pipeline name -> [runs, failed runs]
+        self.failures = dict()
+        # (pipeline name, stage) -> [runs, total seconds, max seconds]
+        self.stages = dict()
+        # (pipeline name, build) -> [runs, failed runs]
+        self.builds = dict()
+        # the latest distinct task definitions deployed
+        self.deployments = OrderedDict()
+        self.deployment_count = 0
+
+    def add(self, pipeline_name, run):
+        state = run['state']
+        self.states[state] += 1
+        failures = self.failures.setdefault(pipeline_name, [0, 0])
+        failures[0] += 1
+        failures[1] += state == 'FAILED'
+
+        for stage, stage_run in run['stages'].items():
+            if stage_run['state'] != 'SUCCEEDED' or stage_run['duration'] is None:
+                continue
+            duration = int(stage_run['duration'])
+            stats = self.stages.setdefault((pipeline_name, stage), [0, 0, 0])
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+
+        for build_field_name, build_run in run['builds'].items():
+            if build_run['state'] == 'IN_PROGRESS':
+                continue
+            stats = self.builds.setdefault((pipeline_name, build_field_name), [0, 0])
+            stats[0] += 1
+            stats[1] += build_run['state'] != 'SUCCEEDED'
+
+        if state == 'SUCCEEDED' and run.get('task_def'):
+            # runs are streamed oldest first, so the ones kept are the latest deployments
+            self.deployments.pop(run['task_def'], None)
+            self.deployments[run['task_def']] = None
+            if len(self.deployments) > DIGEST_TOP_ITEMS:
+                self.deployments.popitem(last=False)
+            self.deployment_count += 1
+
+    def render(self, since, until):
+        total = sum(self.states.values())
+        others = total - self.states['SUCCEEDED'] - self.states['FAILED']
+        runs = f"{STATE_ICONS['SUCCEEDED']} {self.states['SUCCEEDED']} succeeded\t{STATE_ICONS['FAILED']} {self.states['FAILED']} failed"
+        if others:
+            runs += f"\t{others} stopped or superseded"
+
+        fields = [Digest.create_field(f'Runs from {since:%Y-%m-%d %H:%M} to {until:%Y-%m-%d %H:%M} UTC', runs)]
+
+        failed = heapq.nlargest(
+            DIGEST_TOP_ITEMS, ((stats[1], name, stats[0]) for name, stats in self.failures.items() if stats[1])
+        )
+        if failed:
+            fields.append(Digest.create_field('Failed pipelines', '\n'.join(
+                f"`{name}` {failures}/{runs} failed" for failures, name, runs in failed
+            )))
+
+        slowest = heapq.nlargest(
+            DIGEST_TOP_ITEMS, ((stats[1] // stats[0], key, stats[2]) for key, stats in self.stages.items())
+        )
+        if slowest:
+            fields.append(Digest.create_field('Slowest stages', '\n'.join(
+                f"`{name}` {stage} {format_duration(average)} avg (max {format_duration(longest)})"
+                for average, (name, stage), longest in slowest
+            )))
+
+        # builds that both failed and succeeded in the period, highest failure rate first
+        flaky = heapq.nlargest(DIGEST_TOP_ITEMS, (
+            (stats[1] / stats[0], key, stats) for key, stats in self.builds.items() if 0 < stats[1] < stats[0]
+        ))
+        if flaky:
+            fields.append(Digest.create_field('Flakiest builds', '\n'.join(
+                f"`{name}` {build_field_name} {stats[1]}/{stats[0]} failed"
+                for _, (name, build_field_name), stats in flaky
+            )))
+
+        if self.deployment_count:
+            deployments = ', '.join(reversed(self.deployments))
+            fields.append(Digest.create_field(f'Deployments ({self.deployment_count})', deployments))
+
+        return [
+            {
+                "mrkdwn_in": ["fields"],
+                "fields": fields,
+                "color": "danger" if self.states['FAILED'] else "good",
+            }
+        ]
+
+    @staticmethod
+    def create_field(title, value):
+        return {
+            "title": title,
+            "value": value,
+            "short": False
+        }
+
+
+def run(event, context):
+    clear()
+    until = datetime.now(timezone.utc)
+    since = until - timedelta(hours=int((event or {}).get('period_hours', DIGEST_PERIOD_HOURS)))
+    bind(since=since.strftime(EVENT_TIME_FORMAT), until=until.strftime(EVENT_TIME_FORMAT))
+
+    digests = dict()
+    pipelines = 0
+    for pipeline_name in list_pipeline_names():
+        pipelines += 1
+        channels = find_channels(pipeline_name, DIGEST_EVENT_SOURCES, None)
+        for pipeline_run in query_runs(
+            pipeline_name,
+            since.strftime(EVENT_TIME_FORMAT),
+            until.strftime(EVENT_TIME_FORMAT),
+            attributes=RUN_ATTRIBUTES,
+            page_size=DIGEST_PAGE_SIZE,
+        ):
+            for channel in channels:
+                digests.setdefault(channel, Digest()).add(pipeline_name, pipeline_run)
+
+    # channels without runs in the period get no message
+    for channel, digest in digests.items():
+        log('send digest', channel=channel, runs=sum(digest.states.values()))
+        send_message(find_channel_id(channel), digest.render(since, until))
+
+    log('digest sent', pipelines=pipelines, channels=len(digests))
+    return {'channels': len(digests)}
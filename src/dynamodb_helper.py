@@ -1,14 +1,31 @@
 import os
-import boto3
+import time
 import logging
+from lazy import LazyObject, lazy_resource, client_error
+from metrics import timer, timed
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(os.getenv('DYNAMODB_TABLE'))
+dynamodb = lazy_resource('dynamodb')
+table = LazyObject(lambda: dynamodb.Table(os.getenv('DYNAMODB_TABLE')))
+execution_table = LazyObject(lambda: dynamodb.Table(os.getenv('DYNAMODB_EXECUTION_TABLE', 'codepipeline-slack-executions')))
+cache_table = LazyObject(lambda: dynamodb.Table(os.getenv('DYNAMODB_CACHE_TABLE', 'codepipeline-slack-cache')))
+alarm_table = LazyObject(lambda: dynamodb.Table(os.getenv('DYNAMODB_ALARM_TABLE', 'codepipeline-slack-alarms')))
+run_table = LazyObject(lambda: dynamodb.Table(os.getenv('DYNAMODB_RUN_TABLE', 'codepipeline-slack-runs')))
 
+EXECUTION_TTL_DAYS = int(os.getenv('EXECUTION_TTL_DAYS', 30))
 
+# the runs table holds the runs of a pipeline ('run#<ended at>#<execution id>') next to its duration sketches
+RUN_SORT_KEY_PREFIX = 'run#'
+SKETCH_SORT_KEY = 'sketch'
+
+
+class ConflictError(Exception):
+    pass
+
+
+@timed('dynamodb.find_or_create_item')
 def find_or_create_item(deployment_id, *, pipeline_id=None, task_def=None):
     item = table.get_item(Key={'deployment_id': deployment_id}).get('Item')
     if item:
@@ -17,17 +34,388 @@ def find_or_create_item(deployment_id, *, pipeline_id=None, task_def=None):
         table.put_item(Item={'deployment_id':deployment_id, 'pipeline_id':pipeline_id, 'task_def':task_def})
 
 
+@timed('dynamodb.update_item')
 def update_item(*, deployment_id, pipeline_id=None, task_def=None):
-    expression = 'SET'
+    assignments = []
     expression_attributes = dict()
     if pipeline_id != None:
-        expression += f' pipeline_id = :p'
+        assignments.append('pipeline_id = :p')
         expression_attributes[':p'] = pipeline_id
     if task_def != None:
-        expression += f', task_def = :t'
+        assignments.append('task_def = :t')
         expression_attributes[':t'] = task_def
 
     table.update_item(
         Key={'deployment_id':deployment_id},
-        UpdateExpression=expression,
+        UpdateExpression='SET ' + ', '.join(assignments),
         ExpressionAttributeValues=expression_attributes)
+
+
+@timed('dynamodb.find_execution')
+def find_execution(pipeline_execution_id):
+    return execution_table.get_item(Key={'pipeline_execution_id': pipeline_execution_id}).get('Item')
+
+
+@timed('dynamodb.save_execution')
+def save_execution(pipeline_execution_id, *, pipeline_name, state, version):
+    # optimistic concurrency. the write only succeeds on top of the version that was read
+    # raises ConflictError when another invocation saved the execution in the meantime
+    if version:
+        condition = '#v = :expected'
+        expression_attributes = {':expected': version}
+    else:
+        condition = 'attribute_not_exists(#v)'
+        expression_attributes = dict()
+
+    expression_attributes.update({
+        ':p': pipeline_name,
+        ':s': state,
+        ':v': version + 1,
+        ':e': int(time.time()) + EXECUTION_TTL_DAYS * 24 * 60 * 60,
+        ':empty': {},
+    })
+    try:
+        execution_table.update_item(
+            Key={'pipeline_execution_id': pipeline_execution_id},
+            UpdateExpression='SET pipeline_name = :p, #s = :s, #v = :v, expires_at = :e, '
+                             'messages = if_not_exists(messages, :empty)',
+            ConditionExpression=condition,
+            ExpressionAttributeNames={'#s': 'state', '#v': 'version'},
+            ExpressionAttributeValues=expression_attributes)
+    except client_error() as e:
+        if is_conditional_check_failed(e):
+            raise ConflictError(f'execution was updated concurrently. pipeline execution id: {pipeline_execution_id}')
+        raise
+
+    return version + 1
+
+
+@timed('dynamodb.claim_message')
+def claim_message(pipeline_execution_id, channel_id, message_ts):
+    # only the first invocation that posted a message for the execution to a channel keeps it
+    try:
+        execution_table.update_item(
+            Key={'pipeline_execution_id': pipeline_execution_id},
+            UpdateExpression='SET messages.#c = :m',
+            ConditionExpression='attribute_not_exists(messages.#c)',
+            ExpressionAttributeNames={'#c': channel_id},
+            ExpressionAttributeValues={':m': message_ts})
+    except client_error() as e:
+        if is_conditional_check_failed(e):
+            return False
+        raise
+
+    return True
+
+
+@timed('dynamodb.claim_render')
+def claim_render(pipeline_execution_id, version, debounce_seconds=0, rendered_hash=None):
+    # monotonic guard for chat.update. a state version never overwrites a newer rendered one
+    # with debounce_seconds, the claim also fails while the last render is younger than that
+    # rendered_hash is the hash of the payload about to be written
+    now = int(time.time())
+    condition = '(attribute_not_exists(rendered_version) OR rendered_version < :v)'
+    expression_attributes = {':v': version, ':now': now, ':h': rendered_hash}
+    if debounce_seconds:
+        condition += ' AND (attribute_not_exists(rendered_at) OR rendered_at <= :debounce_before)'
+        expression_attributes[':debounce_before'] = now - debounce_seconds
+
+    try:
+        execution_table.update_item(
+            Key={'pipeline_execution_id': pipeline_execution_id},
+            UpdateExpression='SET rendered_version = :v, rendered_at = :now, rendered_hash = :h',
+            ConditionExpression=condition,
+            ExpressionAttributeValues=expression_attributes)
+    except client_error() as e:
+        if is_conditional_check_failed(e):
+            return False
+        raise
+
+    return True
+
+
+@timed('dynamodb.clear_rendered_hash')
+def clear_rendered_hash(pipeline_execution_id):
+    # after a failed write, so the next attempt does not take the message for up to date
+    execution_table.update_item(
+        Key={'pipeline_execution_id': pipeline_execution_id},
+        UpdateExpression='REMOVE rendered_hash')
+
+
+@timed('dynamodb.claim_flush')
+def claim_flush(pipeline_execution_id, delay_seconds):
+    now = int(time.time())
+    try:
+        execution_table.update_item(
+            Key={'pipeline_execution_id': pipeline_execution_id},
+            UpdateExpression='SET flush_due_at = :due',
+            ConditionExpression='attribute_not_exists(flush_due_at) OR flush_due_at < :now',
+            ExpressionAttributeValues={':due': now + delay_seconds, ':now': now})
+    except client_error() as e:
+        if is_conditional_check_failed(e):
+            return False
+        raise
+
+    return True
+
+
+@timed('dynamodb.find_alarm')
+def find_alarm(alarm_key):
+    return alarm_table.get_item(Key={'alarm_key': alarm_key}).get('Item')
+
+
+@timed('dynamodb.record_task_stop')
+def record_task_stop(alarm_key, task, *, window_seconds, ttl_seconds):
+    # counts a stopped task into the open window of the alarm, or opens a new window when the last stop
+    # is older than window_seconds. returns the alarm item and whether this stop opened the window
+    # a redelivered stop whose task is still in recent_tasks is not counted again
+    now = int(time.time())
+    window_start = now - window_seconds
+    expression_attributes = {
+        ':now': now,
+        ':task': [task['task_id']],
+        ':task_id': task['task_id'],
+        ':latest': task,
+        ':e': now + ttl_seconds,
+    }
+    try:
+        return append_task_stop(alarm_key, expression_attributes, window_start), False
+    except client_error() as e:
+        if not is_conditional_check_failed(e):
+            raise
+
+    try:
+        res = alarm_table.update_item(
+            Key={'alarm_key': alarm_key},
+            UpdateExpression='SET window_started_at = :now, last_seen_at = :now, stop_count = :one, '
+                             'recent_tasks = :task, latest = :latest, messages = :empty, rendered_count = :zero, '
+                             'rendered_at = :zero, posting_at = :now, expires_at = :e REMOVE flush_due_at',
+            ConditionExpression='attribute_not_exists(last_seen_at) OR last_seen_at < :window_start',
+            ExpressionAttributeValues=dict(
+                {key: value for key, value in expression_attributes.items() if key != ':task_id'},
+                **{':window_start': window_start, ':one': 1, ':zero': 0, ':empty': {}}
+            ),
+            ReturnValues='ALL_NEW')
+        return res['Attributes'], True
+    except client_error() as e:
+        if not is_conditional_check_failed(e):
+            raise
+
+    # another invocation opened the window in the meantime, so the stop belongs to it
+    try:
+        return append_task_stop(alarm_key, expression_attributes), False
+    except client_error() as e:
+        if not is_conditional_check_failed(e):
+            raise
+
+    # the stop was already counted, by an earlier delivery of the same event
+    return find_alarm(alarm_key), False
+
+
+def append_task_stop(alarm_key, expression_attributes, window_start=None):
+    expression_attributes = dict(expression_attributes, **{':one': 1})
+    condition = 'NOT contains(recent_tasks, :task_id)'
+    if window_start is not None:
+        condition = 'last_seen_at >= :window_start AND ' + condition
+        expression_attributes[':window_start'] = window_start
+
+    res = alarm_table.update_item(
+        Key={'alarm_key': alarm_key},
+        UpdateExpression='SET last_seen_at = :now, recent_tasks = list_append(:task, recent_tasks), '
+                         'latest = :latest, expires_at = :e ADD stop_count :one',
+        ConditionExpression=condition,
+        ExpressionAttributeValues=expression_attributes,
+        ReturnValues='ALL_NEW')
+    return res['Attributes']
+
+
+@timed('dynamodb.trim_alarm_tasks')
+def trim_alarm_tasks(alarm_key, keep, size):
+    # the newest task ids are first. removing an index past the end of the list is a no-op,
+    # so stops appended concurrently only shift which of the old ids go
+    alarm_table.update_item(
+        Key={'alarm_key': alarm_key},
+        UpdateExpression='REMOVE ' + ', '.join(f'recent_tasks[{index}]' for index in range(keep, size)))
+
+
+@timed('dynamodb.claim_alarm_message')
+def claim_alarm_message(alarm_key, window_started_at, channel_id, message_ts):
+    # the message belongs to the window it was posted for. returns the alarm item after the claim,
+    # or None when the channel already has a message or a new window was opened in between
+    try:
+        res = alarm_table.update_item(
+            Key={'alarm_key': alarm_key},
+            UpdateExpression='SET messages.#c = :m',
+            ConditionExpression='window_started_at = :w AND attribute_not_exists(messages.#c)',
+            ExpressionAttributeNames={'#c': channel_id},
+            ExpressionAttributeValues={':m': message_ts, ':w': window_started_at},
+            ReturnValues='ALL_NEW')
+    except client_error() as e:
+        if is_conditional_check_failed(e):
+            return None
+        raise
+
+    return res['Attributes']
+
+
+@timed('dynamodb.claim_alarm_post')
+def claim_alarm_post(alarm_key, window_started_at, lease_seconds):
+    # a window without a message is posted by the first invocation that claims it. the claim expires,
+    # so a window whose post failed is posted by a later stop or by the redelivered event
+    now = int(time.time())
+    try:
+        alarm_table.update_item(
+            Key={'alarm_key': alarm_key},
+            UpdateExpression='SET posting_at = :now',
+            ConditionExpression='window_started_at = :w AND size(messages) = :zero '
+                                'AND (attribute_not_exists(posting_at) OR posting_at <= :lease_before)',
+            ExpressionAttributeValues={
+                ':now': now, ':w': window_started_at, ':zero': 0, ':lease_before': now - lease_seconds
+            })
+    except client_error() as e:
+        if is_conditional_check_failed(e):
+            return False
+        raise
+
+    return True
+
+
+@timed('dynamodb.claim_alarm_render')
+def claim_alarm_render(alarm_key, stop_count, interval_seconds=0):
+    # like claim_render, with the stop count as the version of the alarm message
+    now = int(time.time())
+    try:
+        alarm_table.update_item(
+            Key={'alarm_key': alarm_key},
+            UpdateExpression='SET rendered_count = :n, rendered_at = :now',
+            ConditionExpression='rendered_count < :n AND rendered_at <= :interval_before',
+            ExpressionAttributeValues={':n': stop_count, ':now': now, ':interval_before': now - interval_seconds})
+    except client_error() as e:
+        if is_conditional_check_failed(e):
+            return False
+        raise
+
+    return True
+
+
+@timed('dynamodb.claim_alarm_flush')
+def claim_alarm_flush(alarm_key, delay_seconds):
+    now = int(time.time())
+    try:
+        alarm_table.update_item(
+            Key={'alarm_key': alarm_key},
+            UpdateExpression='SET flush_due_at = :due',
+            ConditionExpression='attribute_not_exists(flush_due_at) OR flush_due_at < :now',
+            ExpressionAttributeValues={':due': now + delay_seconds, ':now': now})
+    except client_error() as e:
+        if is_conditional_check_failed(e):
+            return False
+        raise
+
+    return True
+
+
+@timed('dynamodb.put_run')
+def put_run(item):
+    # runs are append only. a redelivered terminal event finds its run already written
+    try:
+        run_table.put_item(Item=item, ConditionExpression='attribute_not_exists(sk)')
+    except client_error() as e:
+        if is_conditional_check_failed(e):
+            return False
+        raise
+
+    return True
+
+
+@timed('dynamodb.find_run')
+def find_run(pipeline_name, sk):
+    return run_table.get_item(Key={'pipeline_name': pipeline_name, 'sk': sk}, ConsistentRead=True).get('Item')
+
+
+@timed('dynamodb.mark_run_sketched')
+def mark_run_sketched(pipeline_name, sk):
+    run_table.update_item(
+        Key={'pipeline_name': pipeline_name, 'sk': sk},
+        UpdateExpression='SET sketched = :t',
+        ExpressionAttributeValues={':t': True})
+
+
+@timed('dynamodb.find_sketches')
+def find_sketches(pipeline_name):
+    return run_table.get_item(Key={'pipeline_name': pipeline_name, 'sk': SKETCH_SORT_KEY}).get('Item')
+
+
+@timed('dynamodb.save_sketches')
+def save_sketches(pipeline_name, sketches, version):
+    # optimistic concurrency like save_execution
+    if version:
+        condition = '#v = :expected'
+        expression_attributes = {':expected': version}
+    else:
+        condition = 'attribute_not_exists(#v)'
+        expression_attributes = dict()
+
+    expression_attributes.update({':s': sketches, ':v': version + 1})
+    try:
+        run_table.update_item(
+            Key={'pipeline_name': pipeline_name, 'sk': SKETCH_SORT_KEY},
+            UpdateExpression='SET sketches = :s, #v = :v',
+            ConditionExpression=condition,
+            ExpressionAttributeNames={'#v': 'version'},
+            ExpressionAttributeValues=expression_attributes)
+    except client_error() as e:
+        if is_conditional_check_failed(e):
+            raise ConflictError(f'sketches were updated concurrently. pipeline name: {pipeline_name}')
+        raise
+
+    return version + 1
+
+
+def query_runs(pipeline_name, since, until, *, attributes, page_size=100):
+    # the runs of a pipeline that ended between since and until (event time format), oldest first.
+    # one page is held at a time, so memory does not grow with the number of runs
+    names = {f'#a{index}': attribute for index, attribute in enumerate(attributes)}
+    kwargs = {
+        'KeyConditionExpression': 'pipeline_name = :p AND sk BETWEEN :since AND :until',
+        'ExpressionAttributeValues': {
+            ':p': pipeline_name,
+            ':since': f'{RUN_SORT_KEY_PREFIX}{since}',
+            ':until': f'{RUN_SORT_KEY_PREFIX}{until}',
+        },
+        'ProjectionExpression': ', '.join(names),
+        'ExpressionAttributeNames': names,
+        'Limit': page_size,
+    }
+    while True:
+        with timer('dynamodb.query_runs'):
+            res = run_table.query(**kwargs)
+        yield from res['Items']
+
+        if 'LastEvaluatedKey' not in res:
+            return
+        kwargs['ExclusiveStartKey'] = res['LastEvaluatedKey']
+
+
+def is_conditional_check_failed(error):
+    return error.response['Error']['Code'] == 'ConditionalCheckFailedException'
+
+
+@timed('dynamodb.find_cache_items')
+def find_cache_items(cache_keys):
+    if not cache_keys:
+        return {}
+
+    # keys the table could not process in time are treated as cache misses
+    res = dynamodb.batch_get_item(RequestItems={
+        cache_table.name: {'Keys': [{'cache_key': cache_key} for cache_key in set(cache_keys)]}
+    })
+    return {item['cache_key']: item['value'] for item in res['Responses'].get(cache_table.name, [])}
+
+
+@timed('dynamodb.put_cache_items')
+def put_cache_items(items, ttl_days):
+    expires_at = int(time.time()) + ttl_days * 24 * 60 * 60
+    with cache_table.batch_writer() as batch:
+        for cache_key, value in items.items():
+            batch.put_item(Item={'cache_key': cache_key, 'value': value, 'expires_at': expires_at})
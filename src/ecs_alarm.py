@@ -1,93 +1,278 @@
-from event_parser import (
-    get_ecs_task_stopped_reason,
-    get_ecs_task_infos,
-    get_ecs_container_infos,
-)
+import os
+import re
+import json
+import hashlib
+import functools
+from datetime import datetime, timezone
 from slack_helper import (
     send_message,
-    SLACK_CHANNEL,
-    find_channel_id
+    update_message,
+    delete_message,
+    find_channel_id,
+)
+from dynamodb_helper import (
+    find_alarm,
+    record_task_stop,
+    trim_alarm_tasks,
+    claim_alarm_message,
+    claim_alarm_post,
+    claim_alarm_render,
+    claim_alarm_flush,
 )
+from event_parser import create_alarm_flush_event
+from aws_client import enqueue_message, SQS_QUEUE_URL
+from routing import REGEX_PREFIX, compile_pattern, find_channels
+from log_helper import log
+
+REGION = os.getenv("AWS_REGION", "ap-northeast-2")
+
+# stops of the same (cluster, group, stopped reason) are one alarm while they keep coming.
+# the window closes once no task stopped for ECS_ALARM_WINDOW_SECONDS, and the next stop posts a new message
+ECS_ALARM_WINDOW_SECONDS = int(os.getenv('ECS_ALARM_WINDOW_SECONDS', 600))
+# the alarm message is updated at most once per interval, later stops are written by a delayed flush
+ECS_ALARM_UPDATE_SECONDS = int(os.getenv('ECS_ALARM_UPDATE_SECONDS', 10))
+ECS_ALARM_RECENT_TASKS = int(os.getenv('ECS_ALARM_RECENT_TASKS', 5))
+ECS_ALARM_TTL_SECONDS = ECS_ALARM_WINDOW_SECONDS + 24 * 60 * 60
+
+# suppression rules, as a json list inline or in a json file next to the function code
+# [{"clusters": ["batch-*"], "groups": ["service:worker", "re:^family:"], "reasons": ["deployment"]}]
+# a stop is not alarmed when every key of a rule matches it. clusters and groups are names, globs or
+# regexes (re:), a group also matches by its service name. reasons match as substrings or regexes (re:)
+ECS_ALARM_SUPPRESS = os.getenv('ECS_ALARM_SUPPRESS')
+ECS_ALARM_SUPPRESS_FILE = os.getenv('ECS_ALARM_SUPPRESS_FILE')
+# tasks stopped by a deployment are replaced on purpose
+DEFAULT_SUPPRESSION = [{'reasons': ['deployment']}]
+
+
+class NameMatcher:
+    __slots__ = ('exact', 'patterns')
+
+    def __init__(self, names):
+        self.exact = set()
+        self.patterns = []
+        for name in names:
+            pattern = compile_pattern(name)
+            if pattern is not None:
+                self.patterns.append(pattern)
+            else:
+                self.exact.add(name)
+
+    def matches(self, *names):
+        return any(name in self.exact or any(pattern.match(name) for pattern in self.patterns) for name in names)
+
+
+class ReasonMatcher:
+    __slots__ = ('substrings', 'patterns')
+
+    def __init__(self, reasons):
+        self.substrings = [reason for reason in reasons if not reason.startswith(REGEX_PREFIX)]
+        self.patterns = [re.compile(reason[len(REGEX_PREFIX):]) for reason in reasons if reason.startswith(REGEX_PREFIX)]
+
+    def matches(self, reason):
+        return any(substring in reason for substring in self.substrings) \
+            or any(pattern.search(reason) for pattern in self.patterns)
+
+
+class SuppressionRule:
+    __slots__ = ('clusters', 'groups', 'reasons')
+
+    def __init__(self, config):
+        self.clusters = NameMatcher(config['clusters']) if config.get('clusters') else None
+        self.groups = NameMatcher(config['groups']) if config.get('groups') else None
+        self.reasons = ReasonMatcher(config['reasons']) if config.get('reasons') else None
+
+    def matches_group(self, cluster_name, group):
+        if self.clusters is not None and not self.clusters.matches(cluster_name):
+            return False
+        return self.groups is None or self.groups.matches(group, group.split(':')[-1])
+
+
+class SuppressionIndex:
+    # the rules that can match a (cluster, group) are found once, so a storm of stops of one service
+    # only checks the stopped reason against them
+    def __init__(self, rules):
+        self.rules = []
+        for config in rules:
+            if not any(config.get(key) for key in ('clusters', 'groups', 'reasons')):
+                raise ValueError(f'suppression rule without clusters, groups or reasons. rule: {config}')
+            self.rules.append(SuppressionRule(config))
+
+        self.find_rules = functools.lru_cache(maxsize=1024)(self.find_rules)
+
+    def find_rules(self, cluster_name, group):
+        return tuple(rule for rule in self.rules if rule.matches_group(cluster_name, group))
+
+    def is_suppressed(self, cluster_name, group, reason):
+        return any(
+            rule.reasons is None or rule.reasons.matches(reason) for rule in self.find_rules(cluster_name, group)
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def get_suppression_index():
+    # loaded and compiled once per container
+    if ECS_ALARM_SUPPRESS_FILE:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), ECS_ALARM_SUPPRESS_FILE)) as f:
+            return SuppressionIndex(json.load(f))
+
+    return SuppressionIndex(json.loads(ECS_ALARM_SUPPRESS) if ECS_ALARM_SUPPRESS else DEFAULT_SUPPRESSION)
+
+
+def create_alarm_key(event):
+    reason_hash = hashlib.sha1(event.stopped_reason.encode()).hexdigest()[:16]
+    return f'{event.cluster_name}#{event.group}#{reason_hash}'
 
-DO_NOT_ALARM_GROUP = ['']
 
 def alarm_task(event):
-    task_stopped_reason = get_ecs_task_stopped_reason(event)
-    if task_stopped_reason is None:
+    if get_suppression_index().is_suppressed(event.cluster_name, event.group, event.stopped_reason):
+        log('skip suppressed task stop', cluster_name=event.cluster_name, group=event.group)
         return
 
-    if 'deployment' in task_stopped_reason:
-        return
+    alarm_key = create_alarm_key(event)
+    task = {
+        'cluster_name': event.cluster_name,
+        'group': event.group,
+        'stopped_reason': event.stopped_reason,
+        'task_id': event.task_id,
+        'task_definition_name': event.task_definition_name,
+        'containers': [list(container) for container in event.containers],
+    }
+    item, opened = record_task_stop(
+        alarm_key, task, window_seconds=ECS_ALARM_WINDOW_SECONDS, ttl_seconds=ECS_ALARM_TTL_SECONDS
+    )
+    if len(item['recent_tasks']) > 2 * ECS_ALARM_RECENT_TASKS:
+        trim_alarm_tasks(alarm_key, ECS_ALARM_RECENT_TASKS, len(item['recent_tasks']))
 
+    # the window opener posts the message. when its post failed, the next stop or the redelivered event does
+    if opened or (not item['messages'] and claim_alarm_post(
+            alarm_key, item['window_started_at'], ECS_ALARM_UPDATE_SECONDS)):
+        post_alarm(alarm_key, item)
     else:
-        channel_id = find_channel_id(SLACK_CHANNEL)
-        cluster_name, group, task_id, task_definition_name = get_ecs_task_infos(event)
-        if group.split(':')[-1] in DO_NOT_ALARM_GROUP:
+        update_alarm(alarm_key, item)
+
+
+def post_alarm(alarm_key, item):
+    channel_names = find_channels(None, ('aws.ecs',), 'FAILED')
+    claimed = None
+    for channel_id in (find_channel_id(channel_name) for channel_name in channel_names):
+        res = send_message(channel_id, render_alarm(item))
+        log('post alarm message', alarm_key=alarm_key, channel_id=channel_id, message_ts=res['ts'])
+        result = claim_alarm_message(alarm_key, item['window_started_at'], channel_id, res['ts'])
+        if result is None:
+            # a new window was opened while posting, or another invocation posted the window first.
+            # their message replaces this one
+            delete_message(channel_id, res['ts'])
             return
+        claimed = result
 
-        link = "https://ap-northeast-2.console.aws.amazon.com" \
-               "/ecs/home?region=ap-northeast-2#/clusters/{}/tasks/{}/details".format(
-                    cluster_name,
-                    task_id
-                )
-
-        container_infos = get_ecs_container_infos(event)
-        container_info_message = "{:^20} {:^20}\n".format('name', 'reason')
-
-        for container_info in container_infos:
-            container_info_message += "{:^20} {:^20}\n".format(
-                container_info['name'],
-                container_info['reason'],
-            )
-
-        fields = [
-            {
-                "title": ':scream: Task abnormal termination :scream:',
-                "value": "Reason: {}".format(task_stopped_reason),
-                "short": False
-            },
-            {
-                "title": 'Cluster name',
-                "value": cluster_name,
-                "short": True
-            },
-            {
-                "title": 'Group',
-                "value": group,
-                "short": True
-            },
-            {
-                "title": 'Task id',
-                "value": task_id,
-                "short": True
-            },
-            {
-                "title": 'Task definition name',
-                "value": task_definition_name,
-                "short": True
-            },
-            {
-                "title": 'Container Info',
-                "value": "```\n{}\n```".format(container_info_message),
-                "short": False
-            },
-        ]
-
-        action = [{
-                "type": "button",
-                "text": "Task details",
-                "url": link
-        }]
-
-        message = [
-            {
-                "fields": fields,
-                "color": 'danger',
-                "actions": action
-            }
-        ]
-
-        send_message(
-            channel_id,
-            message
-        )
+    claim_alarm_render(alarm_key, item['stop_count'])
+    # stops counted while the message was posted found no message to update
+    if claimed['stop_count'] > item['stop_count']:
+        update_alarm(alarm_key, claimed)
+
+
+def update_alarm(alarm_key, item):
+    # the invocation that posts the message renders the stops counted before it was claimed
+    if not item['messages']:
+        return
+
+    if not claim_alarm_render(alarm_key, item['stop_count'], ECS_ALARM_UPDATE_SECONDS):
+        schedule_alarm_flush(alarm_key)
+        return
+
+    attachments = render_alarm(item)
+    for channel_id, message_ts in item['messages'].items():
+        log('update alarm message', alarm_key=alarm_key, channel_id=channel_id, message_ts=message_ts,
+            stop_count=int(item['stop_count']))
+        update_message(channel_id, message_ts, attachments)
+
+
+def schedule_alarm_flush(alarm_key):
+    # at most one pending flush per alarm. it renders whatever the count is by then
+    if not SQS_QUEUE_URL:
+        log('skip alarm flush without a queue', alarm_key=alarm_key)
+        return
+    if not claim_alarm_flush(alarm_key, ECS_ALARM_UPDATE_SECONDS):
+        return
+
+    log('schedule alarm flush', alarm_key=alarm_key, delay_seconds=ECS_ALARM_UPDATE_SECONDS)
+    enqueue_message(create_alarm_flush_event(alarm_key), ECS_ALARM_UPDATE_SECONDS, group_id=alarm_key)
+
+
+def flush_alarm(event):
+    item = find_alarm(event.alarm_key)
+    if item is None or not item['messages']:
+        return
+
+    if not claim_alarm_render(event.alarm_key, item['stop_count']):
+        return
+
+    attachments = render_alarm(item)
+    for channel_id, message_ts in item['messages'].items():
+        update_message(channel_id, message_ts, attachments)
+
+
+def render_alarm(item):
+    latest = item['latest']
+    cluster_name, group, task_id = latest['cluster_name'], latest['group'], latest['task_id']
+    link = f"https://{REGION}.console.aws.amazon.com/ecs/home?region={REGION}#/clusters/{cluster_name}/tasks/{task_id}/details"
+
+    container_info_message = "{:^20} {:^20}\n".format('name', 'reason')
+    for container_name, container_reason in latest['containers']:
+        container_info_message += "{:^20} {:^20}\n".format(container_name, container_reason)
+
+    window_started_at = datetime.fromtimestamp(int(item['window_started_at']), timezone.utc)
+    stop_count = int(item['stop_count'])
+    recent_tasks = item['recent_tasks'][:ECS_ALARM_RECENT_TASKS]
+
+    fields = [
+        {
+            "title": ':scream: Task abnormal termination :scream:',
+            "value": "Reason: {}".format(latest['stopped_reason']),
+            "short": False
+        },
+        {
+            "title": 'Cluster name',
+            "value": cluster_name,
+            "short": True
+        },
+        {
+            "title": 'Group',
+            "value": group,
+            "short": True
+        },
+        {
+            "title": 'Stopped tasks',
+            "value": "{} since {:%Y-%m-%d %H:%M:%S} UTC".format(stop_count, window_started_at),
+            "short": True
+        },
+        {
+            "title": 'Task definition name',
+            "value": latest['task_definition_name'],
+            "short": True
+        },
+        {
+            "title": 'Recent task ids' if stop_count > 1 else 'Task id',
+            "value": "\n".join(recent_tasks),
+            "short": False
+        },
+        {
+            "title": 'Container Info',
+            "value": "```\n{}\n```".format(container_info_message),
+            "short": False
+        },
+    ]
+
+    action = [{
+        "type": "button",
+        "text": "Task details",
+        "url": link
+    }]
+
+    return [
+        {
+            "fields": fields,
+            "color": 'danger',
+            "actions": action
+        }
+    ]
@@ -1,142 +1,285 @@
 import re
-import logging
 import json
-
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-
-def parse_sqs_message(message):
-    logger.info(json.dumps(message, indent=2))
-    notification = json.loads(message['Records'][0]['body'])
-    return json.loads(notification['Message'])
+import uuid
+from datetime import datetime, timezone
+from dataclasses import dataclass
+from log_helper import log_payload
+
+TASK_DEFINITION_PATTERN = re.compile(r'TaskDefinition: [\w|:\-\/]+')
+CODEPIPELINE_INITIATOR_PREFIX = 'codepipeline/'
+EVENT_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# delayed events the notifier sends to its own queue to write debounced slack updates
+FLUSH_EVENT_SOURCE = 'codepipeline-slack'
+FLUSH_EVENT_DETAIL_TYPE = 'Slack Message Flush'
+ALARM_FLUSH_EVENT_DETAIL_TYPE = 'ECS Alarm Flush'
+
+
+# typed events. every sqs record is parsed once into one of these
+# and handlers never walk the raw event dict again
+
+@dataclass
+class PipelineEvent:
+    source = 'aws.codepipeline'
+    __slots__ = ('id', 'time', 'pipeline_execution_id', 'pipeline_name', 'state')
+    id: str
+    time: str
+    pipeline_execution_id: str
+    pipeline_name: str
+    state: str
+
+
+@dataclass
+class StageEvent:
+    source = 'aws.codepipeline'
+    __slots__ = ('id', 'time', 'pipeline_execution_id', 'pipeline_name', 'stage', 'state')
+    id: str
+    time: str
+    pipeline_execution_id: str
+    pipeline_name: str
+    stage: str
+    state: str
+
+
+@dataclass
+class ActionEvent:
+    source = 'aws.codepipeline'
+    __slots__ = ('id', 'time', 'pipeline_execution_id', 'pipeline_name', 'stage', 'action', 'state',
+                 'provider', 'external_execution_id', 'external_execution_url')
+    id: str
+    time: str
+    pipeline_execution_id: str
+    pipeline_name: str
+    stage: str
+    action: str
+    state: str
+    provider: str
+    external_execution_id: str
+    external_execution_url: str
+
+    def is_deployment(self):
+        return self.stage == 'Deploy' and self.state == 'SUCCEEDED' and self.external_execution_id is not None
+
+    def is_build(self):
+        return self.provider == 'CodeBuild' and self.external_execution_id is not None
+
+
+@dataclass
+class BuildPhase:
+    __slots__ = ('phase_type', 'status', 'duration', 'context')
+    phase_type: str
+    status: str
+    duration: int
+    context: tuple
+
+
+@dataclass
+class BuildEvent:
+    source = 'aws.codebuild'
+    __slots__ = ('id', 'time', 'pipeline_name', 'build_id', 'project_name', 'phases', 'log_location')
+    id: str
+    time: str
+    pipeline_name: str
+    build_id: str
+    project_name: str
+    # None when the event carries no phase information
+    phases: tuple
+    # (log group, log stream) of the build, when the event carries it
+    log_location: tuple
+
+
+@dataclass
+class DeployEvent:
+    source = 'aws.codedeploy'
+    __slots__ = ('id', 'time', 'deployment_id', 'task_def')
+    id: str
+    time: str
+    deployment_id: str
+    task_def: str
+
+
+@dataclass
+class EcsTaskEvent:
+    source = 'aws.ecs'
+    __slots__ = ('id', 'time', 'cluster_name', 'group', 'task_id', 'task_definition_name', 'stopped_reason',
+                 'containers')
+    id: str
+    time: str
+    cluster_name: str
+    group: str
+    task_id: str
+    task_definition_name: str
+    stopped_reason: str
+    # (name, reason) pairs
+    containers: tuple
+
+
+@dataclass
+class FlushEvent:
+    source = FLUSH_EVENT_SOURCE
+    __slots__ = ('id', 'time', 'pipeline_execution_id')
+    id: str
+    time: str
+    pipeline_execution_id: str
+
+
+@dataclass
+class AlarmFlushEvent:
+    source = FLUSH_EVENT_SOURCE
+    __slots__ = ('id', 'time', 'alarm_key')
+    id: str
+    time: str
+    alarm_key: str
+
+
+def parse_sqs_record(record):
+    log_payload('sqs record received', record)
+    body = json.loads(record['body'])
+    # sns notification, or the eventbridge event itself when sqs is the rule target
+    if 'Message' in body:
+        body = json.loads(body['Message'])
+    return parse_event(body)
+
+
+def parse_event(event):
+    parser = PARSERS.get((event['source'], event['detail-type']))
+    if parser is None:
+        return None
+    return parser(event)
 
 
-def get_pipeline_metadata(event):
+def parse_pipeline_event(event):
     detail = event['detail']
-    pipeline_execution_id = detail['execution-id']
-    pipeline_name = detail['pipeline']
-    return pipeline_execution_id, pipeline_name
-
-
-def is_pipeline_state_update(event):
-    return event['detail-type'] == "CodePipeline Pipeline Execution State Change"
-
-
-def is_pipeline_stage_state_update(event):
-    return event['detail-type'] == "CodePipeline Stage Execution State Change"
-
+    return PipelineEvent(event['id'], event['time'], detail['execution-id'], detail['pipeline'], detail['state'])
 
-def get_pipeline_stages(event):
-    return event['detail']['stage']
 
-
-def get_pipeline_states(event):
-    return event['detail']['state']
-
-
-def get_pipeline_metadata_from_codebuild(event):
+def parse_stage_event(event):
     detail = event['detail']
-    pipeline_name = detail['additional-information']['initiator'][13:]
-    build_id = detail['build-id']
-    build_project_name = detail['project-name']
-
-    return pipeline_name, build_id, build_project_name
-
-
-def is_codebuild_phases_updatable(event):
-    return 'phases' in event['detail']['additional-information']
-
-
-def get_codebuild_phases(event):
-    return event['detail']['additional-information']['phases']
+    return StageEvent(
+        event['id'], event['time'], detail['execution-id'], detail['pipeline'], detail['stage'], detail['state']
+    )
 
 
-def has_phase_context(phase):
-    return 'phase-context' in phase
-
-
-def get_phase_context(phase):
-    return phase['phase-context']
-
+def parse_action_event(event):
+    detail = event['detail']
+    execution_result = detail.get('execution-result') or {}
+    return ActionEvent(
+        event['id'],
+        event['time'],
+        detail['execution-id'],
+        detail['pipeline'],
+        detail['stage'],
+        detail['action'],
+        detail['state'],
+        detail.get('type', {}).get('provider'),
+        execution_result.get('external-execution-id'),
+        execution_result.get('external-execution-url'),
+    )
+
+
+def parse_build_event(event):
+    detail = event['detail']
+    additional_information = detail['additional-information']
 
-def get_phase_status(phase):
-    if 'phase-status' in phase:
-        return phase['phase-status']
+    initiator = additional_information.get('initiator', '')
+    if initiator.startswith(CODEPIPELINE_INITIATOR_PREFIX):
+        pipeline_name = initiator[len(CODEPIPELINE_INITIATOR_PREFIX):]
     else:
-        return 'IN_PROGRESS'
+        pipeline_name = None
 
+    phases = additional_information.get('phases')
+    if phases is not None:
+        phases = tuple(parse_build_phase(phase) for phase in phases)
 
-def get_phase_type(phase):
-    if 'phase-type' in phase:
-        return phase['phase-type']
-    else:
-        return None
+    log_info = additional_information.get('logs') or {}
+    log_location = None
+    if log_info.get('group-name') and log_info.get('stream-name'):
+        log_location = (log_info['group-name'], log_info['stream-name'])
 
-
-def get_phase_duration(phase):
-    if 'duration-in-seconds' in phase:
-        return phase['duration-in-seconds']
-    else:
-        return None
+    return BuildEvent(
+        event['id'], event['time'], pipeline_name, detail['build-id'], detail['project-name'], phases, log_location
+    )
 
 
-def is_event_with_deployment_id(event):
-    if event['source'] == 'aws.codedeploy':
-        if event['detail'].get('eventName') == 'CreateDeployment':
-            return True
-    if event['source'] == 'aws.codepipeline' and event['detail-type'] == 'CodePipeline Action Execution State Change':
-        if event['detail']['stage'] == 'Deploy' and event['detail']['state'] == 'SUCCEEDED':
-            if event['detail']['execution-result']:
-                return True
-    return False
+def parse_build_phase(phase):
+    context = phase.get('phase-context') or ()
+    if isinstance(context, str):
+        context = (context,)
 
+    return BuildPhase(
+        phase.get('phase-type'),
+        phase.get('phase-status', 'IN_PROGRESS'),
+        phase.get('duration-in-seconds'),
+        tuple(c for c in context if len(c) > 0 and c != ': '),
+    )
 
-def get_deployment_info_from_codedeploy(event):
-    deployment_id = event['detail']['responseElements'].get('deploymentId')
-    app_spec = event['detail']['requestParameters']['revision']['string']['content']
-    pattern = re.compile(r'TaskDefinition: [\w|:\-\/]+')
-    task_def = pattern.findall(app_spec)[0].split('/')[-1]
-    return deployment_id, task_def
 
+def parse_codedeploy_event(event):
+    detail = event['detail']
+    if detail.get('eventName') != 'CreateDeployment':
+        return None
 
-def get_deployment_info_from_codepipeline(event):
-    deployment_id = event['detail']['execution-result'].get('external-execution-id')
-    pipeline_id = event['detail']['execution-id']
-    return deployment_id, pipeline_id
+    deployment_id = detail['responseElements'].get('deploymentId')
+    app_spec = detail['requestParameters']['revision']['string']['content']
+    task_def = TASK_DEFINITION_PATTERN.findall(app_spec)[0].split('/')[-1]
+    return DeployEvent(event['id'], event['time'], deployment_id, task_def)
 
 
-def get_ecs_task_stopped_reason(event):
-    try:
-        return event['detail']['stoppedReason']
-    except Exception:
+def parse_ecs_task_event(event):
+    detail = event['detail']
+    stopped_reason = detail.get('stoppedReason')
+    if stopped_reason is None:
         return None
 
-
-def get_ecs_task_infos(event):
-    try:
-        resource = event['resources'][0]
-        task_id = resource.split('/')[-1]
-        cluster_name = resource.split('/')[-2]
-        group = event['detail']['group']
-        task_definition_name = event['detail']['taskDefinitionArn'].split('/')[-1]
-        return cluster_name, group, task_id, task_definition_name
-    except Exception as e:
-        logger.exception('error while parsing event.', exc_info=True)
-        return None, None, None, None
-
-
-def get_ecs_container_infos(event):
-    try:
-        containers = event['detail']['containers']
-        container_infos = []
-
-        for container in containers:
-            reason = container.get('reason', '')
-            container_infos.append({
-                'name': container['name'],
-                'reason': reason,
-            })
-        return container_infos
-    except Exception as e:
-        logger.exception('error while parsing event.', exc_info=True)
-        return None
+    resource = event['resources'][0].split('/')
+    return EcsTaskEvent(
+        event['id'],
+        event['time'],
+        resource[-2],
+        detail['group'],
+        resource[-1],
+        detail['taskDefinitionArn'].split('/')[-1],
+        stopped_reason,
+        tuple((container['name'], container.get('reason', '')) for container in detail.get('containers', [])),
+    )
+
+
+def parse_flush_event(event):
+    return FlushEvent(event['id'], event['time'], event['detail']['execution-id'])
+
+
+def parse_alarm_flush_event(event):
+    return AlarmFlushEvent(event['id'], event['time'], event['detail']['alarm-key'])
+
+
+def create_flush_event(pipeline_execution_id):
+    return {
+        'id': str(uuid.uuid4()),
+        'source': FLUSH_EVENT_SOURCE,
+        'detail-type': FLUSH_EVENT_DETAIL_TYPE,
+        'time': datetime.now(timezone.utc).strftime(EVENT_TIME_FORMAT),
+        'detail': {'execution-id': pipeline_execution_id},
+    }
+
+
+def create_alarm_flush_event(alarm_key):
+    return {
+        'id': str(uuid.uuid4()),
+        'source': FLUSH_EVENT_SOURCE,
+        'detail-type': ALARM_FLUSH_EVENT_DETAIL_TYPE,
+        'time': datetime.now(timezone.utc).strftime(EVENT_TIME_FORMAT),
+        'detail': {'alarm-key': alarm_key},
+    }
+
+
+PARSERS = {
+    ('aws.codepipeline', 'CodePipeline Pipeline Execution State Change'): parse_pipeline_event,
+    ('aws.codepipeline', 'CodePipeline Stage Execution State Change'): parse_stage_event,
+    ('aws.codepipeline', 'CodePipeline Action Execution State Change'): parse_action_event,
+    ('aws.codebuild', 'CodeBuild Build Phase Change'): parse_build_event,
+    ('aws.codebuild', 'CodeBuild Build State Change'): parse_build_event,
+    ('aws.codedeploy', 'AWS API Call via CloudTrail'): parse_codedeploy_event,
+    ('aws.ecs', 'ECS Task State Change'): parse_ecs_task_event,
+    (FLUSH_EVENT_SOURCE, FLUSH_EVENT_DETAIL_TYPE): parse_flush_event,
+    (FLUSH_EVENT_SOURCE, ALARM_FLUSH_EVENT_DETAIL_TYPE): parse_alarm_flush_event,
+}
@@ -1,29 +1,52 @@
 import os
 import json
+from concurrent.futures import ThreadPoolExecutor, wait
 from urllib.parse import urlparse, parse_qs
-import boto3
 import requests as re
+from requests.adapters import HTTPAdapter
 import aws_client
 import logging
+from cache import TTLCache, MISSING
+from metrics import timed
+from dynamodb_helper import (
+    find_cache_items,
+    put_cache_items,
+)
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 GITHUB_ACCESS_TOKEN = os.getenv('GITHUB_ACCESS_TOKEN')
+GITHUB_API_URL = os.getenv('GITHUB_API_URL', 'https://api.github.com')
+GITHUB_API_TIMEOUT = float(os.getenv('GITHUB_API_TIMEOUT', 3))
+GITHUB_LOOKUP_DEADLINE = float(os.getenv('GITHUB_LOOKUP_DEADLINE', 5))
+GITHUB_MAX_WORKERS = int(os.getenv('GITHUB_MAX_WORKERS', 8))
+GITHUB_COMMIT_CACHE_TTL_DAYS = int(os.getenv('GITHUB_COMMIT_CACHE_TTL_DAYS', 30))
+UNKNOWN_AUTHOR = 'unknown'
+
+# keep-alive connections to api.github.com are reused between lookups and warm invocations
+session = re.Session()
+session.auth = ('token', GITHUB_ACCESS_TOKEN)
+session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=GITHUB_MAX_WORKERS))
+
+executor = ThreadPoolExecutor(max_workers=GITHUB_MAX_WORKERS)
+
+# commits never change, so authors are cached by (repo, sha) in memory and in dynamodb
+author_cache = TTLCache('github_author', ttl=GITHUB_COMMIT_CACHE_TTL_DAYS * 24 * 60 * 60, max_size=1024)
 
 
 def find_github_info(pipeline_execution_id, pipeline_name):
     infos = []
 
     # action_name, repo, branchname
-    pipeline = aws_client.client.get_pipeline(name=pipeline_name)
+    pipeline = aws_client.get_pipeline(pipeline_name)
     stages = pipeline.get('pipeline').get('stages')
     source_stage = [x for x in stages if x.get('name') == 'Source'][0]
     for action in source_stage.get('actions'):
         infos.append({'name': action['name'], 'repo': action['configuration']['FullRepositoryId'], 'branch': action['configuration']['BranchName']})
 
     # commit_message, commit_link
-    pipeline_execution = aws_client.client.get_pipeline_execution(pipelineName=pipeline_name, pipelineExecutionId=pipeline_execution_id)
+    pipeline_execution = aws_client.get_pipeline_execution(pipeline_execution_id, pipeline_name)
     revisions = pipeline_execution.get('pipelineExecution').get('artifactRevisions')
     for revision in revisions:
         info = [x for x in infos if x['name'] == revision['name']][0]
@@ -34,15 +57,83 @@ def find_github_info(pipeline_execution_id, pipeline_name):
         info['commit_link'] = f"https://github.com/{query.get('FullRepositoryId')[0]}/commit/{query.get('Commit')[0]}"
 
     # author
+    commits = {(info['repo'], info['commit_link'].split('/')[-1]) for info in infos if 'commit_link' in info}
+    authors = find_authors(commits)
     for info in infos:
-        sha = info['commit_link'].split('/')[-1]
-        url = f"/repos/{info['repo']}/commits/{sha}"
-        author = github_api(url).get('commit').get('author').get('name')
-        info['author'] = author
+        if 'commit_link' in info:
+            info['author'] = authors[(info['repo'], info['commit_link'].split('/')[-1])]
+        else:
+            info['author'] = UNKNOWN_AUTHOR
 
     return infos
 
+
+def find_authors(commits):
+    authors = dict()
+
+    for commit in commits:
+        author = author_cache.get(commit)
+        if author is not MISSING:
+            authors[commit] = author
+
+    misses = [commit for commit in commits if commit not in authors]
+    if misses:
+        try:
+            stored = find_cache_items([commit_cache_key(*commit) for commit in misses])
+        except Exception:
+            logger.exception('error while reading github author cache.')
+            stored = dict()
+
+        for commit in misses:
+            value = stored.get(commit_cache_key(*commit))
+            if value is not None:
+                authors[commit] = value['author']
+                author_cache.set(commit, value['author'])
+
+    # looked up concurrently. a slow or failing github never blocks the slack update
+    futures = {executor.submit(find_author, *commit): commit for commit in commits if commit not in authors}
+    if not futures:
+        return authors
+
+    done, not_done = wait(futures, timeout=GITHUB_LOOKUP_DEADLINE)
+    if not_done:
+        logger.warning(f'github author lookup timed out. pending lookups: {len(not_done)}')
+
+    found = dict()
+    for future, commit in futures.items():
+        author = future.result() if future in done else None
+        if author is None:
+            authors[commit] = UNKNOWN_AUTHOR
+            continue
+
+        authors[commit] = author
+        author_cache.set(commit, author)
+        found[commit_cache_key(*commit)] = {'author': author}
+
+    if found:
+        try:
+            put_cache_items(found, ttl_days=GITHUB_COMMIT_CACHE_TTL_DAYS)
+        except Exception:
+            logger.exception('error while writing github author cache.')
+
+    return authors
+
+
+def commit_cache_key(repo, sha):
+    return f'github#{repo}#{sha}'
+
+
+def find_author(repo, sha):
+    url = f"/repos/{repo}/commits/{sha}"
+    try:
+        return github_api(url).get('commit').get('author').get('name')
+    except Exception:
+        logger.exception(f'error while finding github author. url: {url}')
+        return None
+
+
+@timed('github.api')
 def github_api(url):
-    r = re.get('https://api.github.com'+url, auth=('token',GITHUB_ACCESS_TOKEN))
+    r = session.get(GITHUB_API_URL + url, timeout=GITHUB_API_TIMEOUT)
     r_json = json.loads(r.text)
     return r_json
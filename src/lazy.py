@@ -0,0 +1,45 @@
+import threading
+
+# boto3 is the slowest import of the function and its clients load their service models on creation,
+# so they are created on first use instead of when the modules are imported
+
+
+class LazyObject:
+    __slots__ = ('_factory', '_target', '_lock')
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._target = None
+        self._lock = threading.Lock()
+
+    def resolve(self):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    self._target = self._factory()
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+
+def lazy_client(service_name):
+    def create():
+        import boto3
+        return boto3.client(service_name)
+
+    return LazyObject(create)
+
+
+def lazy_resource(service_name):
+    def create():
+        import boto3
+        return boto3.resource(service_name)
+
+    return LazyObject(create)
+
+
+def client_error():
+    # evaluated by the except clauses only once an exception is raised, so botocore is not imported with the modules
+    from botocore.exceptions import ClientError
+    return ClientError
@@ -0,0 +1,47 @@
+import os
+import json
+import random
+import logging
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# share of raw sqs payloads written to the log. 0 disables the dumps, 1 logs every payload
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE', 0))
+
+# fields attached to every record of the event being processed, like execution id and source
+context = dict()
+
+
+class JsonRecord:
+    # serialized only when a handler actually emits the record
+    __slots__ = ('message', 'fields')
+
+    def __init__(self, message, fields):
+        self.message = message
+        self.fields = fields
+
+    def __str__(self):
+        return json.dumps({'message': self.message, **context, **self.fields}, separators=(',', ':'), default=str)
+
+
+def bind(**fields):
+    context.update(fields)
+
+
+def clear():
+    context.clear()
+
+
+def log(message, level=logging.INFO, **fields):
+    if logger.isEnabledFor(level):
+        logger.log(level, JsonRecord(message, fields))
+
+
+def log_exception(message, **fields):
+    logger.exception(JsonRecord(message, fields))
+
+
+def log_payload(message, payload):
+    if LOG_PAYLOAD_SAMPLE_RATE > 0 and random.random() < LOG_PAYLOAD_SAMPLE_RATE:
+        log(message, payload=payload)
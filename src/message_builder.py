@@ -1,34 +1,46 @@
 import json
 import os
-import logging
+import copy
+import hashlib
+import functools
 
 from event_parser import (
-    get_pipeline_metadata,
-    get_pipeline_stages,
-    get_pipeline_states,
-    is_pipeline_stage_state_update,
-    is_pipeline_state_update,
-    has_phase_context,
-    get_phase_context,
-    get_phase_status,
-    get_phase_type,
-    get_phase_duration,
+    PipelineEvent,
+    StageEvent,
+    create_flush_event,
 )
 from slack_helper import (
     find_channel_id,
-    SLACK_CHANNEL,
     update_message,
     send_message,
+    delete_message,
+)
+from dynamodb_helper import (
+    find_execution,
+    save_execution,
+    claim_message,
+    claim_render,
+    claim_flush,
+    clear_rendered_hash,
+    ConflictError,
 )
 from github_helper import (
     find_github_info
 )
 from aws_client import (
-    find_pipeline_schema
+    find_pipeline_schema,
+    enqueue_message,
+    SQS_QUEUE_URL,
+    SQS_FIFO_MODE,
 )
-
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+from routing import find_channels
+from run_analytics import (
+    record_run,
+    find_percentiles,
+    timing_duration,
+    format_duration,
+)
+from log_helper import log, log_exception
 
 SLACK_IN_PROGRESS_EMOJI   = os.getenv("SLACK_IN_PROGRESS_EMOJI", ":building_contruction:")
 SLACK_IN_RESUMED_EMOJI    = os.getenv("SLACK_IN_RESUMED_EMOJI", ":arrow_forward:")
@@ -36,6 +48,29 @@ SLACK_IN_STOPPED_EMOJI    = os.getenv("SLACK_IN_STOPPED_EMOJI", ":double_vertica
 SLACK_IN_SUPERSEDED_EMOJI = os.getenv("SLACK_IN_SUPERSEDED_EMOJI", ":repeat:")
 GITHUB_ICON               = os.getenv("GITHUB_ICON",":github:")
 REGION                    = os.getenv("AWS_REGION", "ap-northeast-2")
+STATE_SAVE_MAX_RETRIES    = int(os.getenv("STATE_SAVE_MAX_RETRIES", 5))
+# non terminal updates within this window after the last slack write are merged into one delayed write
+SLACK_UPDATE_DEBOUNCE_SECONDS = int(os.getenv("SLACK_UPDATE_DEBOUNCE_SECONDS", 0))
+if SQS_FIFO_MODE and SLACK_UPDATE_DEBOUNCE_SECONDS:
+    # the flush of a debounced update needs a per message delay, which fifo queues reject
+    log('debounced updates are disabled on a fifo queue', debounce_seconds=SLACK_UPDATE_DEBOUNCE_SECONDS)
+    SLACK_UPDATE_DEBOUNCE_SECONDS = 0
+# slack rejects or cuts oversized attachments, so the rendered fields are kept within these limits
+SLACK_MAX_FIELDS          = int(os.getenv("SLACK_MAX_FIELDS", 20))
+SLACK_FIELD_VALUE_LIMIT   = int(os.getenv("SLACK_FIELD_VALUE_LIMIT", 2000))
+SLACK_MESSAGE_BUDGET      = int(os.getenv("SLACK_MESSAGE_BUDGET", 12000))
+TRUNCATION_MARK           = '…'
+# run and stage durations next to the p90 of the recent successful runs
+SHOW_DURATIONS            = os.getenv("SHOW_DURATIONS") == 'True'
+DURATION_QUANTILE         = 0.9
+# an excerpt of the build log when a build fails
+SHOW_BUILD_LOG            = os.getenv("SHOW_BUILD_LOG") == 'True'
+# block kit layout inside a colored attachment, instead of legacy attachment fields
+SLACK_BLOCK_KIT           = os.getenv("SLACK_BLOCK_KIT") == 'True'
+# block kit limits a section text to 3000 and a section field to 2000 characters, and a section to 10 fields
+SLACK_BLOCK_TEXT_LIMIT    = 3000
+SLACK_BLOCK_FIELD_LIMIT   = 2000
+SLACK_BLOCK_MAX_FIELDS    = 10
 
 STATE_ICONS = {
   'CANCELED': ":no_entry:",
@@ -43,6 +78,7 @@ STATE_ICONS = {
   'RESUMED': SLACK_IN_RESUMED_EMOJI,
   'STARTED': SLACK_IN_PROGRESS_EMOJI,
   'STOPPED': SLACK_IN_STOPPED_EMOJI,
+  'STOPPING': SLACK_IN_STOPPED_EMOJI,
   'SUCCEEDED': ":white_check_mark:",
   'SUPERSEDED': SLACK_IN_SUPERSEDED_EMOJI,
 }
@@ -115,6 +151,16 @@ CODEBUILD_PHASE_DEPENDENCY = {
     },
 }
 
+TERMINAL_STATES = ('CANCELED', 'FAILED', 'STOPPED', 'SUCCEEDED', 'SUPERSEDED')
+
+TERMINAL_BUILD_PHASE_STATUSES = ('FAILED', 'FAULT', 'TIMED_OUT', 'STOPPED')
+
+# what is collapsed, cumulatively, when a message is over budget. least useful first
+COLLAPSE_BUILD_CONTEXT = 1
+COLLAPSE_SUCCEEDED_BUILDS = 2
+COLLAPSE_BUILD_LOG = 3
+COLLAPSE_GITHUB = 4
+
 STAGE_STATE_ORDER = {
     "Default" : -99,
 
@@ -130,331 +176,622 @@ STAGE_STATE_ORDER = {
     "SUCCEEDED" : 4
 }
 
+def recorded(method):
+    # changes are recorded so they can be replayed on top of a concurrently saved state.
+    # a change that raises is not recorded, so a rebase never replays it
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self.changes.append((method, args, kwargs))
+        return result
+
+    return wrapper
+
+
+# run state of one pipeline execution is kept as structured data in dynamodb
+# and the slack message is a pure render of it. the message text is never parsed back
 class MessageBuilder:
     pipeline_name = None
     pipeline_execution_id = None
-    fields = None
-    actions = []
-    message_id = None
+    version = 0
 
-    def __init__(self, message, pipeline_execution_id, pipeline_name):
-        self.message = message
-        self.pipeline_name = pipeline_name
+    def __init__(self, item, pipeline_execution_id, pipeline_name):
         self.pipeline_execution_id = pipeline_execution_id
+        self.pipeline_name = pipeline_name
+        self.changes = []
+        # set by terminal transitions, which are written to slack without debouncing
+        self.flush_immediately = False
+        # set when the pipeline reaches a terminal state, which records the run
+        self.run_completed = False
+        # build field name of a build that just failed, whose log excerpt is to be attached
+        self.failed_build = None
+        self.load(item)
+
+    def load(self, item):
+        self.state = MessageBuilder.create_state()
+        # channel id -> message ts of every channel the execution was posted to
+        self.messages = dict()
+        # hash of the payload last written to the messages
+        self.rendered_hash = None
+
+        if item:
+            self.state.update(item.get('state', {}))
+            self.pipeline_name = item.get('pipeline_name') or self.pipeline_name
+            self.messages.update(item.get('messages', {}))
+            # executions saved before messages were tracked per channel
+            if item.get('message_ts') and item.get('channel_id') not in self.messages:
+                self.messages[item['channel_id']] = item['message_ts']
+            self.version = item.get('version', 0)
+            self.rendered_hash = item.get('rendered_hash')
+            log('found existing message', messages=self.messages, version=self.version)
+
+    def checkpoint(self):
+        # what an event can change, so that an event failing halfway is undone on the builder
+        # that the other events of the batch still post
+        return (
+            copy.deepcopy(self.state),
+            len(self.changes),
+            (self.flush_immediately, self.run_completed, self.failed_build),
+        )
+
+    def restore(self, checkpoint):
+        self.state, change_count, (self.flush_immediately, self.run_completed, self.failed_build) = checkpoint
+        del self.changes[change_count:]
+
+    def has_message(self):
+        return len(self.messages) > 0
+
+    def rebase(self, item):
+        self.load(item)
+        for method, args, kwargs in self.changes:
+            method(self, *args, **kwargs)
 
-        if message:
-            attachments = message['attachments'][0]
-            self.fields = attachments['fields']
-            self.actions = attachments.get('actions', [])
-            self.message_id = message['ts']
-            logger.info(f'found existing message. message id: {self.message_id}')
-        else:
-            self.fields = [
-                {
-                    "title": self.pipeline_name,
-                    "value": "UNKNOWN",
-                    "short": True
-                 }
-            ]
+    @staticmethod
+    def create_state():
+        return {
+            'pipeline_state': 'UNKNOWN',
+            'stages': {},
+            'stage_order': [],
+            'github': [],
+            'revision': None,
+            'builds': {},
+            'build_context': None,
+            'build_url': None,
+            'task_def': None,
+            # event time of the last update applied per pipeline, stage and build
+            'updated_at': {},
+            # first start and last end event time of the pipeline ('pipeline') and of every stage ('stage#<name>')
+            'timings': {},
+            # build field name -> log excerpt of failed builds ('' when there was no log to read)
+            'build_logs': {},
+        }
 
+    @recorded
     def update_pipeline_message(self, event):
-        if is_pipeline_state_update(event):
-            self.fields[0]['value'] = get_pipeline_states(event)
+        if isinstance(event, PipelineEvent):
+            self.update_timing('pipeline', event)
+        if isinstance(event, StageEvent):
+            self.update_timing(f'stage#{event.stage}', event)
+
+        if isinstance(event, PipelineEvent) and not self.is_stale('pipeline', event.time):
+            self.state['pipeline_state'] = event.state
+            self.flush_immediately |= event.state in TERMINAL_STATES
+            self.run_completed |= event.state in TERMINAL_STATES
 
-        if is_pipeline_stage_state_update(event):
+        if isinstance(event, StageEvent) and not self.is_stale(f'stage#{event.stage}', event.time):
             self.update_stage_field(event)
+            self.flush_immediately |= event.state in TERMINAL_STATES
 
             # add github info
-            logger.info('PIPELINE STAGE UPDATE')
-            if event.get('detail-type') == 'CodePipeline Stage Execution State Change'\
-                 and get_pipeline_stages(event) == 'Source'\
-                 and get_pipeline_states(event) == 'SUCCEEDED':
-                logger.info('SOURCE UPDATE')
-                pipeline_execution_id, pipeline_name = get_pipeline_metadata(event)
-                infos = find_github_info(pipeline_execution_id, pipeline_name)
-                for info in infos:
-                    self.create_github_block(info)
-
-        if self.fields[0]['value'] == 'SUCCEEDED':
-            self.complete_pipeline()
+            if event.stage == 'Source' and event.state == 'SUCCEEDED':
+                log('source stage succeeded. attach github info')
+                self.state['github'] = find_github_info(event.pipeline_execution_id, event.pipeline_name)
+
+    def update_timing(self, key, event):
+        # event times are kept whatever order the events arrive in
+        timing = self.state['timings'].setdefault(key, {})
+        if event.state == 'STARTED' and (timing.get('started_at') is None or event.time < timing['started_at']):
+            timing['started_at'] = event.time
+        if event.state in TERMINAL_STATES and (timing.get('ended_at') is None or event.time > timing['ended_at']):
+            timing['ended_at'] = event.time
 
     def update_stage_field(self, event):
-        current_stage = get_pipeline_stages(event)
-        current_state = get_pipeline_states(event)
-
-        stages_dict = {}
-
-        index, field_refernece = self.get_or_create_field('Stages')
-        stages_string = field_refernece['value']
-
-        if len(stages_string) > 0:
-            for stage_info_string in stages_string.split('\t'):
-                icon, stage_name = stage_info_string.split(" ")
-                stages_dict[stage_name] = icon
-
-        stages_progress_dict = dict()
-        for stage,icon in stages_dict.items():
-            for k,v in STATE_ICONS.items():
-                if v == icon:
-                    stages_progress_dict[stage] = k
-                    break
+        stages = self.state['stages']
 
         # prevent state going backwards
         # AWS CloudWatchEvent doesn't guarantee the event order
-        if STAGE_STATE_ORDER[current_state] >= STAGE_STATE_ORDER[stages_progress_dict.get(current_stage, 'Default')]:
-            stages_progress_dict[current_stage] = current_state
-        stages_dict[current_stage] = STATE_ICONS[stages_progress_dict[current_stage]]
+        if STAGE_STATE_ORDER[event.state] >= STAGE_STATE_ORDER[stages.get(event.stage, 'Default')]:
+            stages[event.stage] = event.state
 
-        pipeline_stage_order = find_pipeline_schema(get_pipeline_metadata(event)[1])
-        field_refernece['value'] = "\t".join([f"{stages_dict[stage]} {stage}" for stage in pipeline_stage_order if stage in stages_dict])
-        self.update_field(index, field_refernece)
-
-    def create_github_block(self,infos):
-        # slack strips all newllines in field.title
-        text = f"{GITHUB_ICON} `{infos['repo']}` on `{infos['branch']}` by {infos['author']}"
-        index, field = self.get_or_create_field(text, short=True)
-        field['value'] = f"<{infos['commit_link']}|{infos['commit_message']}>"
-        self.update_field(index, field)
+        if not self.state['stage_order']:
+            self.state['stage_order'] = find_pipeline_schema(event.pipeline_name)
 
+    @recorded
     def update_deploy_task_definition(self, task_def):
-        task_def_name = task_def.split(':')[0]
-        task_def_revision = task_def.split(':')[1]
-        task_def_link = f"https://{REGION}.console.aws.amazon.com/ecs/home?region={REGION}#/taskDefinitions/{task_def_name}/{task_def_revision}"
-
-        index, field = self.get_or_create_field('Task Definition', short=True)
-        field['value'] = f"<{task_def_link}|{task_def}>"
-        self.update_field(index, field)
-
+        self.state['task_def'] = task_def
+        self.flush_immediately = True
 
+    @recorded
+    def update_build_stage_info(self, stage_name, phases, build_url, build_project_name, event_time=None):
+        if build_url and self.state['build_url'] is None:
+            self.state['build_url'] = build_url
 
-    def update_build_stage_info(self, stage_name, phases, action_states, build_project_name):
-        external_execution_url = action_states['latestExecution']['externalExecutionUrl']
+        build_field_name = MessageBuilder.create_codebuild_name_from_pipeline_stage(stage_name, build_project_name)
 
-        if external_execution_url:
-            self.get_or_create_action("Build info", external_execution_url)
+        # the log is read once, on the event that first reports the failure
+        if SHOW_BUILD_LOG and build_field_name not in self.state['build_logs'] \
+                and any(phase.status in TERMINAL_BUILD_PHASE_STATUSES for phase in phases):
+            self.failed_build = build_field_name
 
         if os.getenv('SHOW_BUILD_PHASE') == 'True':
-            build_field_name = MessageBuilder.create_codebuild_name_from_pipeline_stage(
-                stage_name, build_project_name
-            )
+            if self.is_stale(f'build#{build_field_name}', event_time):
+                return
 
-            index, field = self.get_or_create_field(build_field_name, short=False)
             self.create_phase_context(phases)
-            field['value'] = self.complete_create_codebuild_progress_info(phases, build_field_name)
-            self.update_field(index, field)
+            self.update_codebuild_progress_info(phases, build_field_name)
+
+    def is_stale(self, key, event_time):
+        # AWS CloudWatchEvent doesn't guarantee the event order
+        # an update older than the last one applied to the same pipeline, stage or build is dropped
+        updated_at = self.state['updated_at']
+        if event_time is None:
+            return False
+
+        if key in updated_at and event_time < updated_at[key]:
+            log('drop stale update', key=key, event_time=event_time, updated_at=updated_at[key])
+            return True
+
+        updated_at[key] = event_time
+        return False
 
     def create_phase_context(self, phases):
         context = []
         for phase in phases:
-            if has_phase_context(phase):
-                phase_context = get_phase_context(phase)
-
-                if len(phase_context) > 0 and phase_context[0] != ': ':
-                    context.append(phase_context)
+            context.extend(phase.context)
 
         if len(context) != 0:
-            index, context_field = self.get_or_create_field("Build Context", short=False)
-            context_field['value'] = " ".join(context)
-            self.update_field(index, context_field)
+            self.state['build_context'] = " ".join(context)
 
-    def complete_create_codebuild_progress_info(self, phases, build_field_name):
-        exist_phases, exist_phase_max_level = self.create_exist_codebuild_progress_info(build_field_name)
-        new_phases, new_max_level = self.create_new_codebuild_progress_info(phases)
-
-        if exist_phase_max_level is None and new_max_level is None:
-            return ""
-
-        elif exist_phase_max_level is not None and new_max_level is not None:
-            if exist_phase_max_level <= new_max_level:
-                return self.create_codebuild_progress_info_message(new_phases)
-
-            elif exist_phase_max_level > new_max_level:
-                return self.create_codebuild_progress_info_message(exist_phases)
+    def update_codebuild_progress_info(self, phases, build_field_name):
+        if len(phases) == 0:
+            return
 
-        elif exist_phase_max_level is None and new_max_level is not None:
-            return self.create_codebuild_progress_info_message(new_phases)
-        else:
-            return self.create_codebuild_progress_info_message(exist_phases)
+        new_phases = {}
+        new_max_level = 0
+        for phase in phases:
+            new_phases[phase.phase_type] = {
+                'status': phase.status,
+                'duration': phase.duration
+            }
+            self.flush_immediately |= phase.phase_type == 'COMPLETED' or phase.status in TERMINAL_BUILD_PHASE_STATUSES
+            new_max_level = max(
+                CODEBUILD_PHASE_DEPENDENCY[phase.phase_type]['level'],
+                new_max_level
+            )
 
-    def create_codebuild_progress_info_message(self, phases):
-        total_message = ""
-        for phase_type, phase_info_dict in phases.items():
-            icon = phase_info_dict['icon']
-            duration = phase_info_dict['duration']
-            if not CODEBUILD_PHASE_DEPENDENCY[phase_type]['enable_progress']:
-                icon = BUILD_PHASES['SUCCEEDED']
+        # phase events can arrive out of order. keep the most progressed one
+        exist_build = self.state['builds'].get(build_field_name)
+        if exist_build is None or exist_build['level'] <= new_max_level:
+            self.state['builds'][build_field_name] = {
+                'phases': new_phases,
+                'level': new_max_level
+            }
 
-            message = f"{icon} {phase_type}"
-            if duration is not None:
-                message = f"{message} {duration}"
+    @recorded
+    def attach_build_log(self, build_field_name, excerpt):
+        self.state['build_logs'][build_field_name] = excerpt or ''
+        self.failed_build = None
+        self.flush_immediately = True
 
-            total_message = total_message + '\n' + message
+    @recorded
+    def attach_revision_info(self, revision_info):
+        self.state['revision'] = {
+            key: revision_info[key] for key in ('revisionId', 'revisionSummary', 'revisionUrl') if key in revision_info
+        }
+        self.flush_immediately = True
 
-        return total_message
+    def has_revision_info_field(self):
+        return self.state['revision'] is not None
 
-    def create_new_codebuild_progress_info(self, phases):
-        new_phases = {}
-        phase_max_level = 0
-        if len(phases) == 0:
-            return None, None
+    def color(self):
+        pipeline_status = self.state['pipeline_state']
+        if pipeline_status in STATE_COLORS:
+            return STATE_COLORS[pipeline_status]
+        else:
+            return STATE_COLORS['DEFAULT']
 
-        for phase in phases:
-            phase_status_icon = BUILD_PHASES[get_phase_status(phase)]
-            phase_type = get_phase_type(phase)
-            duration = get_phase_duration(phase)
+    def build_message(self):
+        pipelink_link = f"https://{REGION}.console.aws.amazon.com/codesuite/codepipeline/pipelines/{self.pipeline_name}/view"
+        footer = f"<{pipelink_link}|{self.pipeline_execution_id}>"
+        if SLACK_BLOCK_KIT:
+            return [
+                {
+                    "fallback": f"{self.pipeline_name} {self.state['pipeline_state']}",
+                    "color": self.color(),
+                    "blocks": self.render_blocks(footer)
+                }
+            ]
 
-            new_phases[phase_type] = {
-                'icon': phase_status_icon,
-                'duration': duration
+        return [
+            {
+                "mrkdwn_in": ["fields", "footer"],
+                "fields": self.render_fields(),
+                "color": self.color(),
+                "footer": footer,
+                "actions": self.render_actions()
             }
-            phase_max_level = max(
-                CODEBUILD_PHASE_DEPENDENCY[phase_type]['level'],
-                phase_max_level
-            )
+        ]
 
-        return new_phases, phase_max_level
-
-    def create_exist_codebuild_progress_info(self, build_field_name):
-        index, build_field = self.get_field(build_field_name)
-        if build_field is None:
-            return None, None
-        if "value" not in build_field:
-            return None, None
-        if build_field["value"] == "":
-            return None, None
-
-        build_info = build_field['value']
-        exist_phases = {}
-        phase_max_level = 0
-        for row in build_info.split('\n'):
-            infos = row.strip().split(' ')
-            print(row, len(infos))
-            if len(infos) == 3:
-                icon, phase, duration = infos
-            elif len(infos) == 2:
-                icon, phase = infos
-                duration = None
-            else:
+    def render_blocks(self, footer):
+        # the same fields as the attachment. consecutive short fields share a section in two columns
+        blocks = []
+        short_fields = []
+        for field in self.render_fields():
+            text = f"*{field['title']}*\n{field['value'] or ''}"
+            if field['short']:
+                short_fields.append({"type": "mrkdwn", "text": truncate(text, SLACK_BLOCK_FIELD_LIMIT)})
+                if len(short_fields) < SLACK_BLOCK_MAX_FIELDS:
+                    continue
+            if short_fields:
+                blocks.append({"type": "section", "fields": short_fields})
+                short_fields = []
+            if not field['short']:
+                blocks.append({"type": "section", "text": {"type": "mrkdwn", "text": truncate(text, SLACK_BLOCK_TEXT_LIMIT)}})
+
+        if short_fields:
+            blocks.append({"type": "section", "fields": short_fields})
+
+        actions = self.render_actions()
+        if actions:
+            blocks.append({"type": "actions", "elements": [
+                {"type": "button", "text": {"type": "plain_text", "text": action['text']}, "url": action['url']}
+                for action in actions
+            ]})
+
+        blocks.append({"type": "context", "elements": [{"type": "mrkdwn", "text": footer}]})
+        return blocks
+
+    def render_fields(self):
+        # fields keep a fixed order. a message over the slack limits is collapsed step by step
+        # and only truncated when collapsing is not enough
+        for collapse_level in range(COLLAPSE_GITHUB + 1):
+            fields = self.render_fields_collapsed(collapse_level)
+            if len(fields) <= SLACK_MAX_FIELDS and message_size(fields) <= SLACK_MESSAGE_BUDGET:
+                return fields
+
+        log('message over budget. truncate fields', fields=len(fields), size=message_size(fields))
+        return truncate_fields(fields)
+
+    def render_fields_collapsed(self, collapse_level):
+        state = self.state
+        fields = [MessageBuilder.create_field(
+            self.pipeline_name, state['pipeline_state'] + self.render_duration('pipeline')
+        )]
+
+        if state['stages']:
+            fields.append(MessageBuilder.create_field('Stages', self.render_stages()))
+
+        if collapse_level >= COLLAPSE_GITHUB and len(state['github']) > 1:
+            fields.append(MessageBuilder.create_field(f"{GITHUB_ICON} Sources", self.render_github_summary(), short=False))
+        else:
+            for info in state['github']:
+                # slack strips all newllines in field.title
+                fields.append(MessageBuilder.create_field(
+                    f"{GITHUB_ICON} `{info['repo']}` on `{info['branch']}` by {info['author']}",
+                    f"<{info['commit_link']}|{info['commit_message']}>"
+                ))
+
+        if state['revision'] is not None:
+            fields.append(MessageBuilder.create_field('Revision', self.render_revision()))
+
+        succeeded_builds = []
+        for build_field_name in sorted(state['builds']):
+            phases = state['builds'][build_field_name]['phases']
+            if collapse_level >= COLLAPSE_SUCCEEDED_BUILDS and self.is_build_succeeded(phases):
+                succeeded_builds.append(build_field_name)
                 continue
 
-            exist_phases[phase] = {
-                'icon': icon,
-                'duration': duration
-            }
-            phase_max_level = max(
-                CODEBUILD_PHASE_DEPENDENCY[phase]['level'],
-                phase_max_level
-            )
+            fields.append(MessageBuilder.create_field(
+                build_field_name,
+                self.render_codebuild_progress_info(phases),
+                short=False
+            ))
 
-        return exist_phases, phase_max_level
+        if succeeded_builds:
+            fields.append(MessageBuilder.create_field(
+                'Builds', f"{BUILD_PHASES['SUCCEEDED']} {len(succeeded_builds)} succeeded", short=False
+            ))
 
-    def get_or_create_field(self, title, short=True):
-        index, field = self.get_field(title)
-        logger.info('index, field')
-        logger.info(f'{index}, {field}')
-        if field is not None:
-            return index, field
+        if collapse_level < COLLAPSE_BUILD_LOG:
+            for build_field_name in sorted(state['build_logs']):
+                if state['build_logs'][build_field_name]:
+                    fields.append(MessageBuilder.create_field(
+                        f"{build_field_name} | Log", f"```\n{state['build_logs'][build_field_name]}\n```", short=False
+                    ))
 
-        new_field = {
-            "title": title,
-            "value": "",
-            "short": short
-        }
-        self.fields.append(new_field)
-        return len(self.fields) - 1, new_field
+        if state['build_context'] and collapse_level < COLLAPSE_BUILD_CONTEXT:
+            fields.append(MessageBuilder.create_field('Build Context', state['build_context'], short=False))
 
-    def get_field(self, title):
-        for index, field in enumerate(self.fields):
-            if field['title'] == title:
-                return index, field
-        return None, None
+        if state['task_def']:
+            fields.append(MessageBuilder.create_field('Task Definition', self.render_task_definition()))
 
-    def update_field(self, index, value):
-        if index >= len(self.fields) or index < 0:
-            raise ValueError(f'index out of range. input index: {index}. max length: {len(self.fields)}')
+        for field in fields:
+            field['value'] = truncate(field['value'], SLACK_FIELD_VALUE_LIMIT)
 
-        self.fields[index] = value
+        return fields
 
-    def get_or_create_action(self, name, link):
-        for index, action in enumerate(self.actions):
-            if action['text'] == name:
-                return index, action
+    def render_actions(self):
+        if self.state['build_url'] is None:
+            return []
 
-        action = {
+        return [{
             "type": "button",
-            "text": name,
-            "url": link
-        }
-        self.actions.append(action)
-        return len(self.actions) - 1, self.actions[-1]
+            "text": "Build info",
+            "url": self.state['build_url']
+        }]
+
+    def render_stages(self):
+        stages = self.state['stages']
+        order = list(self.state['stage_order']) + sorted(set(stages) - set(self.state['stage_order']))
+        return "\t".join([
+            f"{self.render_state_icon(stages[stage])} {stage}{self.render_duration(f'stage#{stage}')}"
+            for stage in order if stage in stages
+        ])
+
+    def render_state_icon(self, state):
+        # stage states are persisted, so a state without an icon would fail every later render of the execution
+        return STATE_ICONS.get(self.completed_state(state), SLACK_IN_PROGRESS_EMOJI)
+
+    def render_duration(self, key):
+        # ' 4m12s (p90 3m40s)' once the pipeline or stage is over
+        if not SHOW_DURATIONS:
+            return ''
+
+        seconds = timing_duration(self.state['timings'].get(key))
+        if seconds is None:
+            return ''
+
+        percentile = find_percentiles(self.pipeline_name).get(key, {}).get(DURATION_QUANTILE)
+        if percentile is None:
+            return f" {format_duration(seconds)}"
+        return f" {format_duration(seconds)} (p{round(DURATION_QUANTILE * 100)} {format_duration(percentile)})"
+
+    def render_codebuild_progress_info(self, phases):
+        total_message = ""
+        for phase_type in sorted(phases, key=lambda phase_type: CODEBUILD_PHASE_DEPENDENCY[phase_type]['level']):
+            status = self.completed_phase_status(phases[phase_type]['status'])
+            duration = phases[phase_type]['duration']
+            icon = BUILD_PHASES[status]
+            if not CODEBUILD_PHASE_DEPENDENCY[phase_type]['enable_progress']:
+                icon = BUILD_PHASES['SUCCEEDED']
 
-    def update_action(self, index, value):
-        if index >= len(self.actions) or index < 0:
-            raise ValueError(f'index out of range. input index: {index}. max length: {len(self.actions)}')
+            message = f"{icon} {phase_type}"
+            if duration is not None:
+                message = f"{message} {duration}"
 
-        self.actions[index] = value
+            total_message = total_message + '\n' + message
 
-    def attach_revision_info(self, revision_info):
+        return total_message
+
+    def render_github_summary(self):
+        return "\n".join(
+            f"`{info['repo']}` on `{info['branch']}` by {info['author']}: <{info['commit_link']}|{info['commit_message']}>"
+            for info in self.state['github']
+        )
+
+    def is_build_succeeded(self, phases):
+        return 'COMPLETED' in phases and all(
+            self.completed_phase_status(phase['status']) == 'SUCCEEDED'
+            for phase_type, phase in phases.items() if phase_type != 'COMPLETED'
+        )
+
+    def build_state(self, phases):
+        if self.is_build_succeeded(phases):
+            return 'SUCCEEDED'
+        for phase in phases.values():
+            status = self.completed_phase_status(phase['status'])
+            if status in TERMINAL_BUILD_PHASE_STATUSES:
+                return status
+        return 'IN_PROGRESS'
+
+    def render_revision(self):
+        revision_info = self.state['revision']
         if 'revisionUrl' in revision_info:
-            self.fields.append({
-                "title": "Revision",
-                "value": f"<{revision_info['revisionUrl']}|{revision_info['revisionId'][:7]}:"
-                f" {revision_info['revisionSummary']}>",
-                "short": True
-            })
+            return f"<{revision_info['revisionUrl']}|{revision_info['revisionId'][:7]}: {revision_info['revisionSummary']}>"
         else:
-            self.fields.append({
-                "title": "Revision",
-                "value": revision_info['revisionSummary'],
-                "short": True
-            })
+            return revision_info['revisionSummary']
 
-    def has_revision_info_field(self):
-        for field in self.fields:
-            if field['title'] == 'Revision':
-                return True
+    def render_task_definition(self):
+        task_def = self.state['task_def']
+        task_def_name = task_def.split(':')[0]
+        task_def_revision = task_def.split(':')[1]
+        task_def_link = f"https://{REGION}.console.aws.amazon.com/ecs/home?region={REGION}#/taskDefinitions/{task_def_name}/{task_def_revision}"
+        return f"<{task_def_link}|{task_def}>"
 
-        return False
+    # a succeeded pipeline shows whatever is still in progress as succeeded
+    def completed_state(self, state):
+        if self.state['pipeline_state'] == 'SUCCEEDED' and state == 'STARTED':
+            return 'SUCCEEDED'
+        return state
 
-    def color(self):
-        pipeline_status = self.fields[0]['value']
-        if pipeline_status in STATE_COLORS:
-            return STATE_COLORS[pipeline_status]
-        else:
-            return STATE_COLORS['DEFAULT']
+    def completed_phase_status(self, status):
+        if self.state['pipeline_state'] == 'SUCCEEDED' and status == 'IN_PROGRESS':
+            return 'SUCCEEDED'
+        return status
 
-    def build_message(self):
-        pipelink_link = f"https://{REGION}.console.aws.amazon.com/codesuite/codepipeline/pipelines/{self.pipeline_name}/view"
-        return [
-            {
-                "mrkdwn_in": ["fields", "footer"],
-                "fields": self.fields,
-                "color": self.color(),
-                "footer": f"<{pipelink_link}|{self.pipeline_execution_id}>",
-                "actions": self.actions
-            }
-        ]
-
-    def complete_pipeline(self):
-        for index, field in enumerate(self.fields):
-            if isinstance(field['value'], str):
-                field['value'].replace(BUILD_PHASES['IN_PROGRESS'], BUILD_PHASES['SUCCEEDED'])
-                field['value'].replace(STATE_ICONS['STARTED'], STATE_ICONS['SUCCEEDED'])
-
-                self.fields[index] = field
+    @staticmethod
+    def create_field(title, value, short=True):
+        return {
+            "title": title,
+            "value": value,
+            "short": short
+        }
 
     @staticmethod
     def create_codebuild_name_from_pipeline_stage(stage_name, codebuild_name):
         return f"Stage: {stage_name} | CodeBuild: {codebuild_name}"
 
 
-def post_message(message_builder):
-    channel_id = find_channel_id(SLACK_CHANNEL)
-    message = message_builder.build_message()
-    message_id = message_builder.message_id
-    if message_builder.message_id is not None:
-        print('update message', message_id)
-        update_message(channel_id, message_builder.message_id, message)
-    else:
-        print('send message', message_id)
-        send_message(channel_id, message)
+def message_size(fields):
+    return sum(len(field['title'] or '') + len(field['value'] or '') for field in fields)
+
+
+def truncate(value, limit):
+    # the result, with its mark and a code fence closed again, is at most limit long.
+    # links (<url|text>) and code fences are never left cut open, so the rest still renders
+    if value is None or len(value) <= limit:
+        return value
+    if limit <= len(TRUNCATION_MARK):
+        return TRUNCATION_MARK[:limit]
+
+    text = value[:limit - len(TRUNCATION_MARK)]
+    while True:
+        if text.rfind('<') > text.rfind('>'):
+            text = text[:text.rfind('<')]
+        # the backticks of a fence that was cut
+        if not text.endswith('```'):
+            text = text.rstrip('`')
+        closing = '\n```' if text.count('```') % 2 else ''
+        if len(text) + len(TRUNCATION_MARK) + len(closing) <= limit:
+            return text + TRUNCATION_MARK + closing
+        text = text[:limit - len(TRUNCATION_MARK) - len(closing)]
+
+
+def truncate_fields(fields):
+    # the first fields (status, stages, sources) are the most useful, the last ones give way
+    if len(fields) > SLACK_MAX_FIELDS:
+        hidden = len(fields) - SLACK_MAX_FIELDS + 1
+        fields = fields[:SLACK_MAX_FIELDS - 1] + [MessageBuilder.create_field(f'{hidden} more fields', '', short=False)]
+
+    # titles, the more fields marker among them, are counted first so the values share what is left
+    remaining = SLACK_MESSAGE_BUDGET - sum(len(field['title'] or '') for field in fields)
+    for field in fields:
+        field['value'] = truncate(field['value'], max(remaining, 0))
+        remaining -= len(field['value'] or '')
+
+    return fields
+
+
+def payload_hash(attachments):
+    return hashlib.sha256(json.dumps(attachments, sort_keys=True, separators=(',', ':')).encode()).hexdigest()[:32]
+
+
+def post_message(message_builder, event_sources=()):
+    # returns whether a message was written to slack
+    save_state(message_builder)
+    written = write_message(message_builder, event_sources)
+
+    # after the slack write, which a failing runs table never holds back
+    if message_builder.run_completed:
+        try:
+            record_run(message_builder)
+        except Exception:
+            log_exception('error while recording run')
+        message_builder.run_completed = False
+
+    return written
+
+
+def write_message(message_builder, event_sources):
+    # channels keep receiving updates once posted to, even when the routing no longer matches
+    channel_ids = [
+        find_channel_id(channel)
+        for channel in find_channels(message_builder.pipeline_name, event_sources, message_builder.state['pipeline_state'])
+    ]
+    new_channel_ids = [channel_id for channel_id in dict.fromkeys(channel_ids) if channel_id not in message_builder.messages]
+    update_channel_ids = list(message_builder.messages)
+
+    # new messages are never debounced
+    debounce_seconds = SLACK_UPDATE_DEBOUNCE_SECONDS
+    if message_builder.flush_immediately or not update_channel_ids:
+        debounce_seconds = 0
+
+    # events that change nothing visible, like duplicates or rejected stale states, write nothing to slack
+    attachments = message_builder.build_message()
+    rendered_hash = payload_hash(attachments)
+    if not new_channel_ids and rendered_hash == message_builder.rendered_hash:
+        log('skip unchanged message', version=message_builder.version, rendered_hash=rendered_hash)
+        return False
+
+    # an older state version never overwrites a newer one already rendered by another invocation
+    rendered = claim_render(
+        message_builder.pipeline_execution_id, message_builder.version, debounce_seconds, rendered_hash
+    )
+
+    for channel_id in new_channel_ids:
+        send_new_message(message_builder, channel_id, rendered, attachments)
+
+    if not update_channel_ids:
+        return True
+
+    if not rendered:
+        log('skip message update', version=message_builder.version, debounce_seconds=debounce_seconds)
+        if debounce_seconds:
+            schedule_flush(message_builder)
+        return len(new_channel_ids) > 0
+
+    try:
+        for channel_id in update_channel_ids:
+            log('update message', channel_id=channel_id, message_ts=message_builder.messages[channel_id],
+                version=message_builder.version)
+            update_message(channel_id, message_builder.messages[channel_id], attachments)
+    except Exception:
+        clear_rendered_hash(message_builder.pipeline_execution_id)
+        raise
+    return True
+
+
+def schedule_flush(message_builder):
+    # at most one pending flush per execution. it renders whatever the latest state is by then
+    if not SQS_QUEUE_URL:
+        log('skip message flush without a queue')
+        return
+    if SQS_FIFO_MODE:
+        log('skip message flush on a fifo queue')
+        return
+    if not claim_flush(message_builder.pipeline_execution_id, SLACK_UPDATE_DEBOUNCE_SECONDS):
+        return
+
+    log('schedule message flush', delay_seconds=SLACK_UPDATE_DEBOUNCE_SECONDS)
+    enqueue_message(
+        create_flush_event(message_builder.pipeline_execution_id), SLACK_UPDATE_DEBOUNCE_SECONDS,
+        group_id=message_builder.pipeline_execution_id,
+    )
+
+
+def save_state(message_builder):
+    if not message_builder.changes:
+        return
+
+    for attempt in range(STATE_SAVE_MAX_RETRIES):
+        try:
+            message_builder.version = save_execution(
+                message_builder.pipeline_execution_id,
+                pipeline_name=message_builder.pipeline_name,
+                state=message_builder.state,
+                version=message_builder.version,
+            )
+            return
+        except ConflictError:
+            log('state conflict. rebase changes', attempt=attempt)
+            message_builder.rebase(find_execution(message_builder.pipeline_execution_id))
+
+    raise ConflictError(f'can not save state. pipeline execution id: {message_builder.pipeline_execution_id}')
+
+
+def send_new_message(message_builder, channel_id, rendered, attachments):
+    log('send message', channel_id=channel_id, version=message_builder.version)
+    res = send_message(channel_id, attachments)
+
+    if claim_message(message_builder.pipeline_execution_id, channel_id, res['ts']):
+        message_builder.messages[channel_id] = res['ts']
+        return
+
+    # another invocation posted the message for this execution and channel first. keep theirs
+    log('message posted concurrently. delete duplicate', channel_id=channel_id, message_ts=res['ts'])
+    delete_message(channel_id, res['ts'])
+    item = find_execution(message_builder.pipeline_execution_id)
+    message_builder.messages[channel_id] = item['messages'][channel_id]
+    # the render claim was taken before posting. a newer version claimed since then renders itself
+    if rendered and int(item.get('rendered_version', 0)) == message_builder.version:
+        update_message(channel_id, message_builder.messages[channel_id], attachments)
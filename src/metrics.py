@@ -0,0 +1,80 @@
+import os
+import json
+import time
+import functools
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# cloudwatch embedded metric format. lines printed to stdout are turned into metrics by cloudwatch logs
+# https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'CodePipelineSlack')
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True') == 'True'
+
+EVENT_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# event source of the record being processed, used as a dimension of every metric
+context = {'event_source': 'none'}
+
+
+class Timing:
+    __slots__ = ('status',)
+
+    def __init__(self):
+        self.status = 'ok'
+
+
+def set_event_source(event_source):
+    context['event_source'] = event_source or 'none'
+
+
+def emit(metric_name, value, unit='Milliseconds', **dimensions):
+    if not METRICS_ENABLED:
+        return
+
+    dimensions['event_source'] = context['event_source']
+    print(json.dumps({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRICS_NAMESPACE,
+                'Dimensions': [list(dimensions)],
+                'Metrics': [{'Name': metric_name, 'Unit': unit}],
+            }],
+        },
+        metric_name: value,
+        **dimensions,
+    }, separators=(',', ':')))
+
+
+@contextmanager
+def timer(operation):
+    timing = Timing()
+    started_at = time.perf_counter()
+    try:
+        yield timing
+    except Exception:
+        timing.status = 'error'
+        raise
+    finally:
+        emit('Latency', round((time.perf_counter() - started_at) * 1000, 1), operation=operation, status=timing.status)
+
+
+def timed(operation):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(operation):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def emit_event_lag(event_time):
+    # from the eventbridge event time to now, after the slack write completed
+    if event_time is None:
+        return
+
+    created_at = datetime.strptime(event_time, EVENT_TIME_FORMAT).replace(tzinfo=timezone.utc)
+    emit('EventLag', round((datetime.now(timezone.utc) - created_at).total_seconds() * 1000), operation='notify')
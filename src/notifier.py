@@ -1,21 +1,21 @@
 import os
-import logging
-import json
+import time
 
 from event_parser import (
-    parse_sqs_message,
-    get_pipeline_metadata,
-    get_pipeline_metadata_from_codebuild,
-    is_codebuild_phases_updatable,
-    get_codebuild_phases,
-    is_event_with_deployment_id,
-    get_deployment_info_from_codedeploy,
-    get_deployment_info_from_codepipeline,
+    parse_sqs_record,
+    PipelineEvent,
+    StageEvent,
+    ActionEvent,
+    BuildEvent,
+    DeployEvent,
+    EcsTaskEvent,
+    FlushEvent,
+    AlarmFlushEvent,
 )
-from slack_helper import find_slack_message_for_update
 from dynamodb_helper import (
     find_or_create_item,
     update_item,
+    find_execution,
 )
 from message_builder import (
     MessageBuilder,
@@ -24,79 +24,286 @@ from message_builder import (
 from aws_client import (
     find_revision_info,
     find_pipeline_from_build,
+    index_build,
+    reset_request_context,
+    SQS_FIFO_MODE,
+)
+from cache import (
+    cache_stats,
+    reset_cache_stats,
+)
+from metrics import (
+    set_event_source,
+    emit_event_lag,
+)
+from log_helper import (
+    bind,
+    clear,
+    log,
+    log_exception,
 )
-from ecs_alarm import alarm_task
-
 
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+# handlers issue their independent aws, dynamodb and slack calls concurrently
+ASYNC_MODE = os.getenv('ASYNC_MODE') == 'True'
 
 
 def run(message, context):
-    event = parse_sqs_message(message)
-    logger.info('event received.')
-    logger.info(json.dumps(event, indent=2))
-    if event['detail-type'] == 'AWS API Call via CloudTrail' and event['source'] == 'aws.codebuild':
-        logger.info('skip CloudTrail | codebuild')
+    # events of the same pipeline execution are folded into one message builder
+    # so that a batch produces a single slack write per execution
+    batch = dict()
+    batch_item_failures = []
+    failed_message_groups = set()
+    reset_cache_stats()
+    reset_request_context()
+
+    for record in message['Records']:
+        message_id = record['messageId']
+        message_group_id = get_message_group_id(record)
+        started_at = time.perf_counter()
+        clear()
+        bind(message_id=message_id)
+        set_event_source(None)
+
+        if message_group_id in failed_message_groups:
+            log('skip record after a failure in its message group', message_group_id=message_group_id)
+            batch_item_failures.append(message_id)
+            continue
+
+        checkpoints = [(group['message_builder'], group['message_builder'].checkpoint()) for group in batch.values()]
+        try:
+            event = parse_sqs_record(record)
+            bind_event(event)
+            message_builder = process_event(event, batch)
+        except Exception:
+            log_exception('error while processing record')
+            # the record is retried, so none of its changes reach the messages posted for the batch
+            for batch_message_builder, checkpoint in checkpoints:
+                batch_message_builder.restore(checkpoint)
+            batch_item_failures.append(message_id)
+            if message_group_id is not None:
+                failed_message_groups.add(message_group_id)
+            continue
+
+        log('event processed', duration_ms=elapsed_ms(started_at))
+        if message_builder is not None:
+            group = batch.setdefault(message_builder.pipeline_execution_id, {
+                'message_builder': message_builder,
+                'message_ids': [],
+                'events': [],
+            })
+            group['message_ids'].append(message_id)
+            group['events'].append((event.source, event.time))
+
+    for pipeline_execution_id, group in batch.items():
+        started_at = time.perf_counter()
+        clear()
+        bind(pipeline_execution_id=pipeline_execution_id)
+        set_event_source(group['events'][0][0])
+        try:
+            event_sources = [event_source for event_source, _ in group['events']]
+            posted = post_message(message_builder=group['message_builder'], event_sources=event_sources)
+        except Exception:
+            log_exception('error while posting message')
+            batch_item_failures.extend(group['message_ids'])
+            continue
+
+        log('message posted', events=len(group['message_ids']), posted=posted, duration_ms=elapsed_ms(started_at))
+        # debounced events reach slack with a later flush, so their lag is not known here
+        if not posted:
+            continue
+
+        for event_source, event_time in group['events']:
+            set_event_source(event_source)
+            emit_event_lag(event_time)
+
+    if SQS_FIFO_MODE:
+        batch_item_failures = get_fifo_batch_item_failures(message['Records'], batch_item_failures)
+
+    clear()
+    log('batch processed', records=len(message['Records']), failures=len(batch_item_failures), cache=cache_stats())
+    return {
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in batch_item_failures]
+    }
+
+
+def get_message_group_id(record):
+    if not SQS_FIFO_MODE:
+        return None
+    return record.get('attributes', {}).get('MessageGroupId')
+
+
+def get_fifo_batch_item_failures(records, batch_item_failures):
+    # a fifo message group must not move past a failed record,
+    # so every record after the first failure of its group is returned to the queue as well
+    failed_message_ids = set(batch_item_failures)
+    failed_message_groups = set()
+    fifo_batch_item_failures = []
+    for record in records:
+        message_group_id = get_message_group_id(record)
+        if record['messageId'] in failed_message_ids or message_group_id in failed_message_groups:
+            failed_message_groups.add(message_group_id)
+            fifo_batch_item_failures.append(record['messageId'])
+
+    return fifo_batch_item_failures
+
+
+def bind_event(event):
+    bind(event_type=type(event).__name__)
+    if event is None:
         return
-    if event['source'] == "aws.codepipeline":
-        process_code_pipeline(event)
-    elif event['source'] == "aws.codebuild":
-        process_code_build(event)
-    elif event['source'] == "aws.codedeploy":
-        process_code_deploy(event)
-    # elif event['source'] == "aws.ecs":
-        # alarm_task(event)
-
-def process_code_pipeline(event):
-    pipeline_execution_id, pipeline_name = get_pipeline_metadata(event)
-    message = find_slack_message_for_update(pipeline_execution_id)
-    message_builder = MessageBuilder(message, pipeline_execution_id, pipeline_name)
+
+    bind(event_id=event.id, source=event.source)
+    set_event_source(event.source)
+    pipeline_execution_id = getattr(event, 'pipeline_execution_id', None)
+    if pipeline_execution_id is not None:
+        bind(pipeline_execution_id=pipeline_execution_id)
+
+
+def elapsed_ms(started_at):
+    return round((time.perf_counter() - started_at) * 1000, 1)
+
+
+def process_event(event, batch):
+    if ASYNC_MODE:
+        # imported on demand, so the synchronous mode never loads asyncio
+        from async_handlers import ASYNC_HANDLERS
+        from async_io import run
+        if type(event) in ASYNC_HANDLERS:
+            return run(ASYNC_HANDLERS[type(event)](event, batch))
+
+    handler = HANDLERS.get(type(event))
+    if handler is None:
+        log('skip unsupported event')
+        return None
+    return handler(event, batch)
+
+
+def get_message_builder(batch, pipeline_execution_id, pipeline_name):
+    if pipeline_execution_id in batch:
+        return batch[pipeline_execution_id]['message_builder']
+
+    item = find_execution(pipeline_execution_id)
+    return MessageBuilder(item, pipeline_execution_id, pipeline_name)
+
+
+def process_code_pipeline(event, batch):
+    pipeline_execution_id, pipeline_name = event.pipeline_execution_id, event.pipeline_name
+    message_builder = get_message_builder(batch, pipeline_execution_id, pipeline_name)
     message_builder.update_pipeline_message(event=event)
 
+    if isinstance(event, ActionEvent) and event.is_build():
+        index_action_build(event)
+
     if message_builder.has_revision_info_field():
         revision_info = find_revision_info(pipeline_execution_id, pipeline_name)
         message_builder.attach_revision_info(revision_info)
 
-    if is_event_with_deployment_id(event):
-        deployment_id, pipeline_id = get_deployment_info_from_codepipeline(event)
+    if isinstance(event, ActionEvent) and event.is_deployment():
+        deployment_id, pipeline_id = event.external_execution_id, pipeline_execution_id
         item = find_or_create_item(deployment_id=deployment_id, pipeline_id=pipeline_id)
         if item:
             update_item(deployment_id=deployment_id, pipeline_id=pipeline_id)
             task_def = item.get('task_def')
             message_builder.update_deploy_task_definition(task_def)
         else:
-            return
+            return None
+
+    return message_builder
+
 
-    post_message(message_builder=message_builder)
+def index_action_build(event):
+    # codebuild phase events only carry the build id. only terminal action events carry it too, so this indexes
+    # the phase events that arrive after them. the ones of a running build are resolved by find_pipeline_from_build
+    index_build(
+        event.external_execution_id,
+        pipeline_execution_id=event.pipeline_execution_id,
+        stage_name=event.stage,
+        action_name=event.action,
+        build_url=event.external_execution_url,
+    )
 
 
-def process_code_build(event):
-    pipeline_name, build_id, build_project_name = get_pipeline_metadata_from_codebuild(event)
-    stage_name, pipeline_execution_id, action_state = find_pipeline_from_build(pipeline_name, build_id)
+def process_code_build(event, batch):
+    if event.pipeline_name is None:
+        return None
+
+    stage_name, pipeline_execution_id, build_url = find_pipeline_from_build(event.pipeline_name, event.build_id)
 
     if not pipeline_execution_id:
-        return
+        return None
 
-    message = find_slack_message_for_update(pipeline_execution_id)
-    message_builder = MessageBuilder(message, pipeline_execution_id, pipeline_name)
+    bind(pipeline_execution_id=pipeline_execution_id)
+    message_builder = get_message_builder(batch, pipeline_execution_id, event.pipeline_name)
 
-    if is_codebuild_phases_updatable(event):
-        phases = get_codebuild_phases(event)
-        message_builder.update_build_stage_info(stage_name, phases, action_state, build_project_name)
+    if event.phases is not None:
+        message_builder.update_build_stage_info(
+            stage_name, event.phases, build_url, event.project_name, event_time=event.time
+        )
 
-    post_message(message_builder=message_builder)
+    if message_builder.failed_build is not None:
+        attach_build_log(message_builder, event)
 
+    return message_builder
 
-def process_code_deploy(event):
-    if is_event_with_deployment_id(event):
-        deployment_id, task_def = get_deployment_info_from_codedeploy(event)
-        item = find_or_create_item(deployment_id=deployment_id, task_def=task_def)
-        if item:
-            update_item(deployment_id=deployment_id, task_def=task_def)
-            pipeline_id = item.get('pipeline_id')
-            message = find_slack_message_for_update(pipeline_id)
-            message_builder = MessageBuilder(message, pipeline_id, "ARBITRARY_PIPELINE_NAME")
-            message_builder.update_deploy_task_definition(task_def)
-        else:
-            return
+
+def attach_build_log(message_builder, event):
+    # imported on demand, only failed builds read their log
+    from build_log import find_build_log_excerpt
+    excerpt = find_build_log_excerpt(event.build_id, event.log_location)
+    log('attach build log', build=message_builder.failed_build, excerpt_size=len(excerpt or ''))
+    message_builder.attach_build_log(message_builder.failed_build, excerpt)
+
+
+def process_code_deploy(event, batch):
+    deployment_id, task_def = event.deployment_id, event.task_def
+    item = find_or_create_item(deployment_id=deployment_id, task_def=task_def)
+    if not item:
+        return None
+
+    update_item(deployment_id=deployment_id, task_def=task_def)
+    pipeline_id = item.get('pipeline_id')
+    # the deployment is not linked to its execution until the deploy action event arrives, which then
+    # reads the task definition from the item
+    if pipeline_id is None:
+        return None
+
+    bind(pipeline_execution_id=pipeline_id)
+    message_builder = get_message_builder(batch, pipeline_id, None)
+    # the pipeline name is only known once the execution has a message
+    if not message_builder.has_message():
+        return None
+
+    message_builder.update_deploy_task_definition(task_def)
+    return message_builder
+
+
+def process_flush(event, batch):
+    message_builder = get_message_builder(batch, event.pipeline_execution_id, None)
+    if not message_builder.has_message():
+        return None
+
+    message_builder.flush_immediately = True
+    return message_builder
+
+
+def process_ecs_task(event, batch):
+    # imported on demand like every handler module that only some event types need
+    from ecs_alarm import alarm_task
+    return alarm_task(event)
+
+
+def process_alarm_flush(event, batch):
+    from ecs_alarm import flush_alarm
+    return flush_alarm(event)
+
+
+HANDLERS = {
+    PipelineEvent: process_code_pipeline,
+    StageEvent: process_code_pipeline,
+    ActionEvent: process_code_pipeline,
+    BuildEvent: process_code_build,
+    DeployEvent: process_code_deploy,
+    FlushEvent: process_flush,
+    EcsTaskEvent: process_ecs_task,
+    AlarmFlushEvent: process_alarm_flush,
+}
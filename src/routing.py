@@ -0,0 +1,101 @@
+import os
+import re
+import json
+import fnmatch
+import functools
+from slack_helper import SLACK_CHANNEL
+
+# routing rules, as a json list inline or in a json file next to the function code
+# [{"pipelines": ["api-*", "re:^batch-(dev|prod)$", "web"], "sources": ["aws.codebuild"], "states": ["FAILED"],
+#   "channels": ["builds-alert"]}]
+# every key but channels is optional. an execution goes to the channels of every matching rule,
+# or to SLACK_CHANNEL when no rule matches
+SLACK_ROUTES = os.getenv('SLACK_ROUTES')
+SLACK_ROUTES_FILE = os.getenv('SLACK_ROUTES_FILE')
+
+REGEX_PREFIX = 're:'
+GLOB_CHARACTERS = ('*', '?', '[')
+
+
+def compile_pattern(name):
+    # None for an exact name, which callers look up in a dict instead
+    if name.startswith(REGEX_PREFIX):
+        return re.compile(name[len(REGEX_PREFIX):])
+    if any(character in name for character in GLOB_CHARACTERS):
+        return re.compile(fnmatch.translate(name))
+    return None
+
+
+class Rule:
+    __slots__ = ('position', 'sources', 'states', 'channels')
+
+    def __init__(self, position, sources, states, channels):
+        self.position = position
+        self.sources = frozenset(sources) if sources else None
+        self.states = frozenset(states) if states else None
+        self.channels = tuple(channels)
+
+    def matches(self, event_sources, state):
+        if self.sources is not None and self.sources.isdisjoint(event_sources):
+            return False
+        # without a state (the digest), a rule restricted to states still matches
+        return self.states is None or state is None or state in self.states
+
+
+class RouteIndex:
+    # exact pipeline names are a dict lookup and the rules matching a pipeline name are computed once,
+    # so routing cost does not grow with the rule count once a pipeline has been seen
+    def __init__(self, rules):
+        self.exact = dict()
+        self.patterns = []
+        self.wildcards = []
+
+        for position, config in enumerate(rules):
+            if not config.get('channels'):
+                raise ValueError(f'routing rule without channels. rule: {config}')
+
+            rule = Rule(position, config.get('sources'), config.get('states'), config['channels'])
+            pipelines = config.get('pipelines')
+            if not pipelines:
+                self.wildcards.append(rule)
+                continue
+
+            for pipeline in pipelines:
+                pattern = compile_pattern(pipeline)
+                if pattern is not None:
+                    self.patterns.append((pattern, rule))
+                else:
+                    self.exact.setdefault(pipeline, []).append(rule)
+
+        self.find_rules = functools.lru_cache(maxsize=1024)(self.find_rules)
+
+    def find_rules(self, pipeline_name):
+        rules = list(self.wildcards)
+        if pipeline_name is not None:
+            rules.extend(self.exact.get(pipeline_name, ()))
+            rules.extend(rule for pattern, rule in self.patterns if pattern.match(pipeline_name))
+
+        # a rule listing the pipeline more than once still routes once, in config order
+        return tuple(sorted({rule.position: rule for rule in rules}.values(), key=lambda rule: rule.position))
+
+    def route(self, pipeline_name, event_sources, state):
+        channels = []
+        for rule in self.find_rules(pipeline_name):
+            if rule.matches(event_sources, state):
+                channels.extend(channel for channel in rule.channels if channel not in channels)
+
+        return channels or [SLACK_CHANNEL]
+
+
+@functools.lru_cache(maxsize=None)
+def get_route_index():
+    # loaded and compiled once per container
+    if SLACK_ROUTES_FILE:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), SLACK_ROUTES_FILE)) as f:
+            return RouteIndex(json.load(f))
+
+    return RouteIndex(json.loads(SLACK_ROUTES) if SLACK_ROUTES else [])
+
+
+def find_channels(pipeline_name, event_sources, state):
+    return get_route_index().route(pipeline_name, frozenset(event_sources), state)
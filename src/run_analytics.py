@@ -0,0 +1,197 @@
+import os
+import math
+import time
+from decimal import Decimal
+from datetime import datetime, timezone
+from cache import TTLCache, cached
+from dynamodb_helper import (
+    put_run,
+    find_run,
+    mark_run_sketched,
+    find_sketches,
+    save_sketches,
+    ConflictError,
+    RUN_SORT_KEY_PREFIX,
+)
+from event_parser import EVENT_TIME_FORMAT
+from log_helper import log
+
+RUN_TTL_DAYS = int(os.getenv('RUN_TTL_DAYS', 90))
+SKETCH_SAVE_MAX_RETRIES = int(os.getenv('SKETCH_SAVE_MAX_RETRIES', 5))
+SKETCH_CACHE_TTL = int(os.getenv('SKETCH_CACHE_TTL', 300))
+
+# durations within SKETCH_GAMMA of each other share a bucket, so quantiles are off by at most ~2.5%
+SKETCH_GAMMA = 1.05
+# every new duration weighs the older ones down, so the quantiles follow the recent runs
+SKETCH_DECAY = float(os.getenv('SKETCH_DECAY', 0.95))
+# buckets decayed below this weight are dropped, which bounds the sketch size
+SKETCH_MIN_WEIGHT = 0.01
+
+QUANTILES = (0.5, 0.9, 0.99)
+
+sketch_cache = TTLCache('duration_sketch', ttl=SKETCH_CACHE_TTL, max_size=256)
+
+
+class DurationSketch:
+    # streaming quantiles of durations in seconds. log spaced buckets of exponentially decayed weights
+    __slots__ = ('buckets',)
+
+    def __init__(self, buckets=None):
+        self.buckets = {int(index): float(weight) for index, weight in (buckets or {}).items()}
+
+    def add(self, seconds):
+        for index, weight in list(self.buckets.items()):
+            weight *= SKETCH_DECAY
+            if weight < SKETCH_MIN_WEIGHT:
+                del self.buckets[index]
+            else:
+                self.buckets[index] = weight
+
+        index = bucket_index(seconds)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def quantile(self, q):
+        total = sum(self.buckets.values())
+        if not total:
+            return None
+
+        cumulative = 0
+        for index in sorted(self.buckets):
+            cumulative += self.buckets[index]
+            if cumulative >= q * total:
+                return bucket_value(index)
+
+        return bucket_value(max(self.buckets))
+
+    def to_item(self):
+        # dynamodb numbers are decimals
+        return {str(index): Decimal(str(round(weight, 4))) for index, weight in self.buckets.items()}
+
+
+def bucket_index(seconds):
+    return math.ceil(math.log(max(seconds, 1)) / math.log(SKETCH_GAMMA))
+
+
+def bucket_value(index):
+    # the middle of (gamma^(index - 1), gamma^index]
+    return round(2 * SKETCH_GAMMA ** index / (SKETCH_GAMMA + 1))
+
+
+def parse_time(event_time):
+    return datetime.strptime(event_time, EVENT_TIME_FORMAT).replace(tzinfo=timezone.utc)
+
+
+def timing_duration(timing):
+    if not timing or not timing.get('started_at') or not timing.get('ended_at'):
+        return None
+    return max(int((parse_time(timing['ended_at']) - parse_time(timing['started_at'])).total_seconds()), 0)
+
+
+def format_duration(seconds):
+    if seconds < 60:
+        return f'{seconds}s'
+    if seconds < 60 * 60:
+        return f'{seconds // 60}m{seconds % 60:02d}s'
+    return f'{seconds // 3600}h{seconds % 3600 // 60:02d}m'
+
+
+def create_run(message_builder):
+    # a compact record of a finished execution. durations come from the event times of the pipeline
+    # and its stages and from the phase durations codebuild reports
+    state = message_builder.state
+    timings = state['timings']
+    pipeline_timing = timings.get('pipeline') or {}
+    ended_at = pipeline_timing.get('ended_at') or datetime.now(timezone.utc).strftime(EVENT_TIME_FORMAT)
+
+    builds = dict()
+    for build_field_name, build in state['builds'].items():
+        phases = {
+            phase_type: int(phase['duration'])
+            for phase_type, phase in build['phases'].items() if phase['duration'] is not None
+        }
+        builds[build_field_name] = {
+            'state': message_builder.build_state(build['phases']),
+            'duration': sum(phases.values()),
+            'phases': phases,
+        }
+
+    return {
+        'pipeline_name': message_builder.pipeline_name,
+        'sk': f'{RUN_SORT_KEY_PREFIX}{ended_at}#{message_builder.pipeline_execution_id}',
+        'pipeline_execution_id': message_builder.pipeline_execution_id,
+        'state': state['pipeline_state'],
+        'started_at': pipeline_timing.get('started_at'),
+        'ended_at': ended_at,
+        'duration': timing_duration(pipeline_timing),
+        'stages': {
+            stage: {'state': stage_state, 'duration': timing_duration(timings.get(f'stage#{stage}'))}
+            for stage, stage_state in state['stages'].items()
+        },
+        'builds': builds,
+        'task_def': state['task_def'],
+        'expires_at': int(time.time()) + RUN_TTL_DAYS * 24 * 60 * 60,
+    }
+
+
+def record_run(message_builder):
+    run = create_run(message_builder)
+    if put_run(run):
+        log('run recorded', sk=run['sk'], duration=run['duration'])
+    elif (find_run(run['pipeline_name'], run['sk']) or {}).get('sketched'):
+        log('run already recorded', sk=run['sk'])
+        return
+
+    # a redelivered terminal event finds its run written, but its durations not yet in the sketches
+    # when the first attempt failed in between
+    update_sketches(run)
+    mark_run_sketched(run['pipeline_name'], run['sk'])
+
+
+def run_observations(run):
+    # only successful runs describe how long a pipeline normally takes
+    observations = dict()
+    if run['state'] == 'SUCCEEDED' and run['duration'] is not None:
+        observations['pipeline'] = run['duration']
+    for stage, stage_run in run['stages'].items():
+        if stage_run['state'] == 'SUCCEEDED' and stage_run['duration'] is not None:
+            observations[f'stage#{stage}'] = stage_run['duration']
+    for build_field_name, build_run in run['builds'].items():
+        if build_run['state'] == 'SUCCEEDED' and build_run['phases']:
+            observations[f'build#{build_field_name}'] = build_run['duration']
+    return observations
+
+
+def update_sketches(run):
+    observations = run_observations(run)
+    if not observations:
+        return
+
+    pipeline_name = run['pipeline_name']
+    for attempt in range(SKETCH_SAVE_MAX_RETRIES):
+        item = find_sketches(pipeline_name) or {}
+        sketches = {key: DurationSketch(buckets) for key, buckets in item.get('sketches', {}).items()}
+        for key, seconds in observations.items():
+            sketches.setdefault(key, DurationSketch()).add(seconds)
+
+        try:
+            save_sketches(pipeline_name, {key: sketch.to_item() for key, sketch in sketches.items()},
+                          int(item.get('version', 0)))
+        except ConflictError:
+            log('sketch conflict. retry', attempt=attempt)
+            continue
+
+        sketch_cache.set((pipeline_name,), create_percentiles(sketches))
+        return
+
+    raise ConflictError(f'can not save sketches. pipeline name: {pipeline_name}')
+
+
+def create_percentiles(sketches):
+    return {key: {q: sketch.quantile(q) for q in QUANTILES} for key, sketch in sketches.items()}
+
+
+@cached(sketch_cache)
+def find_percentiles(pipeline_name):
+    # key ('pipeline', 'stage#<name>', 'build#<field name>') -> {quantile: seconds}
+    item = find_sketches(pipeline_name) or {}
+    return create_percentiles({key: DurationSketch(buckets) for key, buckets in item.get('sketches', {}).items()})
@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import random
+import threading
+import logging
+import requests as re
+from requests.adapters import HTTPAdapter
+from metrics import timer
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+SLACK_BOT_TOKEN = os.getenv("SLACK_BOT_TOKEN")
+SLACK_API_URL = os.getenv("SLACK_API_URL", "https://slack.com/api/")
+SLACK_API_TIMEOUT = float(os.getenv("SLACK_API_TIMEOUT", 5))
+SLACK_API_MAX_RETRIES = int(os.getenv("SLACK_API_MAX_RETRIES", 3))
+SLACK_API_BACKOFF_BASE = float(os.getenv("SLACK_API_BACKOFF_BASE", 0.5))
+# longer waits are left to the sqs redrive instead of burning the lambda timeout
+SLACK_API_MAX_RETRY_WAIT = float(os.getenv("SLACK_API_MAX_RETRY_WAIT", 10))
+
+# requests per minute of the slack web api rate limit tier of each method
+# https://api.slack.com/docs/rate-limits
+RATE_LIMITS = {
+    'auth.test': 100,
+    'conversations.list': 20,
+    'conversations.history': 50,
+    'chat.update': 50,
+    'chat.delete': 50,
+    'chat.postMessage': 60,
+}
+DEFAULT_RATE_LIMIT = 20
+
+# a request that timed out, lost its connection or failed with a 5xx may have been handled, and posting it again
+# leaves a duplicate message. these methods are only retried when the connection could not be made, or on a 429
+NON_IDEMPOTENT_METHODS = {'chat.postMessage'}
+
+HEADERS = {'Authorization' : f'Bearer {SLACK_BOT_TOKEN}', 'Content-Type': 'application/json; charset=utf-8'}
+
+session = re.Session()
+session.headers.update(HEADERS)
+session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+
+class RateLimitBucket:
+    # token bucket refilled at the tier rate. a 429 blocks the bucket for Retry-After seconds
+    def __init__(self, per_minute):
+        self.capacity = max(1, per_minute // 10)
+        self.rate = per_minute / 60
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+            wait = max(self.blocked_until - now, 0)
+            if self.tokens < 1:
+                wait = max(wait, (1 - self.tokens) / self.rate)
+            self.tokens -= 1
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def block(self, seconds):
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+buckets = dict()
+
+
+def get_bucket(method):
+    if method not in buckets:
+        buckets[method] = RateLimitBucket(RATE_LIMITS.get(method, DEFAULT_RATE_LIMIT))
+    return buckets[method]
+
+
+def api_get(method, params=None):
+    return api_call('GET', method, params=params)
+
+
+def api_post(method, data=None):
+    return api_call('POST', method, data=json.dumps(data))
+
+
+def api_call(http_method, method, params=None, data=None):
+    bucket = get_bucket(method)
+    idempotent = method not in NON_IDEMPOTENT_METHODS
+    retried_errors = re.exceptions.RequestException if idempotent else re.exceptions.ConnectTimeout
+
+    for attempt in range(SLACK_API_MAX_RETRIES + 1):
+        bucket.acquire()
+        try:
+            with timer(f'slack.{method}') as timing:
+                r = session.request(http_method, SLACK_API_URL + method, params=params, data=data, timeout=SLACK_API_TIMEOUT)
+                timing.status = str(r.status_code)
+        except retried_errors:
+            if attempt == SLACK_API_MAX_RETRIES:
+                raise
+            logger.warning(f'slack api request failed. method: {method}, attempt: {attempt}')
+            time.sleep(backoff(attempt))
+            continue
+
+        if r.status_code != 429 and (r.status_code < 500 or not idempotent):
+            break
+
+        delay = retry_after(r) or backoff(attempt)
+        if r.status_code == 429:
+            # the next acquire waits until the bucket is unblocked
+            bucket.block(delay)
+        if attempt == SLACK_API_MAX_RETRIES or delay > SLACK_API_MAX_RETRY_WAIT:
+            break
+
+        logger.warning(f'slack api retry. method: {method}, status: {r.status_code}, delay: {delay}')
+        if r.status_code != 429:
+            time.sleep(delay)
+
+    try:
+        return json.loads(r.text)
+    except ValueError:
+        return {'ok': False, 'error': f'http_{r.status_code}'}
+
+
+def backoff(attempt):
+    return SLACK_API_BACKOFF_BASE * (2 ** attempt) * (1 + random.random() / 2)
+
+
+def retry_after(response):
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
@@ -1,43 +1,32 @@
 import os
-import json
-import requests as re
 import logging
+import slack_client
+from cache import TTLCache, cached
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-SLACK_BOT_TOKEN = os.getenv("SLACK_BOT_TOKEN")
 SLACK_CHANNEL = os.getenv("SLACK_CHANNEL", "builds_test")
 SLACK_BOT_NAME = os.getenv("SLACK_BOT_NAME", "PipelineBot")
 SLACK_BOT_ICON = os.getenv("SLACK_BOT_ICON", ":robot_face:")
 SLACK_CHANNEL_ID = os.getenv('SLACK_CHANNEL_OVERRIDE_CHANNEL_ID')
+SLACK_CACHE_TTL = int(os.getenv('SLACK_CACHE_TTL', 3600))
 
-def find_slack_message_for_update(pipeline_execution_id):
-    channel_id = find_channel_id(SLACK_CHANNEL)
-    slack_bot_info = slack_api_get(url='auth.test')
-    slack_bot_id = slack_bot_info['user_id']
-    slack_messages = get_slack_messages_from_channel(channel_id=channel_id)
+# errors meaning the cached channel id is no longer valid
+CHANNEL_ERRORS = ('channel_not_found', 'is_archived', 'not_in_channel')
 
-    for message in slack_messages:
-        if message.get('user', '') != slack_bot_id:
-            continue
-
-        attachments = message.get('attachments', [])
-        for attachment in attachments:
-            if 'footer' not in attachment:
-                continue
-            if attachment['footer'].split('|')[-1].split('>')[0] == pipeline_execution_id:
-                return message
-
-    return None
+channel_cache = TTLCache('slack_channel', ttl=SLACK_CACHE_TTL, max_size=64)
 
 
+@cached(channel_cache)
 def find_channel_id(channel_name):
     # slack api does not provide effcient search for channel(conversation) id by channel name
     # an option to override the api call if channel_id is provided
     # slack sometimes have issue with channel id changing randomly
     # use with caution
     # ALSO there's a ratelimit to this api
-    if SLACK_CHANNEL_ID:
+    # channel ids are cached in the warm container and invalidated when slack rejects the channel
+    # the override only replaces the default channel, routed channels are looked up by name
+    if SLACK_CHANNEL_ID and channel_name == SLACK_CHANNEL:
         return SLACK_CHANNEL_ID
 
     # 최신 메세지가 가장 위쪽에 있게 줌
@@ -48,6 +37,7 @@ def find_channel_id(channel_name):
             err_message = ''
         else:
             err_message = res['error']
+        invalidate_channel_cache(err_message)
         raise ValueError(f'can not read channel list. error message from slack:{err_message}')
 
     channels = res['channels']
@@ -59,23 +49,28 @@ def find_channel_id(channel_name):
     raise ValueError(f'can not find channel. channel name:{channel_name}')
 
 
-def get_slack_messages_from_channel(channel_id):
-    res = slack_api_get(url='conversations.history', params={'channel':channel_id, 'limit':10})
+def update_message(channel_id, message_id, attachments):
+    res = slack_api_post(url='chat.update', data={
+        'channel':channel_id,
+        'ts':message_id,
+        'username':SLACK_BOT_NAME,
+        'attachments':attachments
+    })
 
     if 'error' in res:
         if not isinstance(res['error'], str):
             err_message = ''
         else:
             err_message = res['error']
-        raise ValueError(f'can not read channel list. error message from slack:{err_message}')
+        invalidate_channel_cache(err_message)
+        raise ValueError(f'can update message. error message from slack:{err_message}')
 
-    return res['messages']
+    return res
 
 
-def update_message(channel_id, message_id, attachments):
-    res = slack_api_post(url='chat.update', data={
+def send_message(channel_id, attachments):
+    res = slack_api_post(url='chat.postMessage', data={
         'channel':channel_id,
-        'ts':message_id,
         'username':SLACK_BOT_NAME,
         'attachments':attachments
     })
@@ -85,16 +80,16 @@ def update_message(channel_id, message_id, attachments):
             err_message = ''
         else:
             err_message = res['error']
+        invalidate_channel_cache(err_message)
         raise ValueError(f'can update message. error message from slack:{err_message}')
 
     return res
 
 
-def send_message(channel_id, attachments):
-    res = slack_api_post(url='chat.postMessage', data={
+def delete_message(channel_id, message_id):
+    res = slack_api_post(url='chat.delete', data={
         'channel':channel_id,
-        'username':SLACK_BOT_NAME,
-        'attachments':attachments
+        'ts':message_id
     })
 
     if 'error' in res:
@@ -102,19 +97,19 @@ def send_message(channel_id, attachments):
             err_message = ''
         else:
             err_message = res['error']
-        raise ValueError(f'can update message. error message from slack:{err_message}')
+        raise ValueError(f'can not delete message. error message from slack:{err_message}')
 
     return res
 
 
-HEADERS = {'Authorization' : f'Bearer {SLACK_BOT_TOKEN}', 'Content-Type': 'application/json; charset=utf-8'}
-def slack_api_get(url='', params={}):
-    r = re.get('https://slack.com/api/'+url, params=params, headers=HEADERS)
-    r_json = json.loads(r.text)
-    return r_json
+def invalidate_channel_cache(err_message):
+    if err_message in CHANNEL_ERRORS:
+        channel_cache.invalidate()
+
+
+def slack_api_get(url='', params=None):
+    return slack_client.api_get(url, params=params)
 
 
 def slack_api_post(url='', data=None):
-    r = re.post('https://slack.com/api/'+url, headers=HEADERS, data=json.dumps(data))
-    r_json = json.loads(r.text)
-    return r_json
+    return slack_client.api_post(url, data=data)
@@ -64,11 +64,21 @@ module "lambda_function" {
         },
         {
             "Action": [
-                "codebuild:Get*"
+                "codebuild:Get*",
+                "codebuild:BatchGetBuilds"
             ],
             "Resource": "*",
             "Effect": "Allow"
         },
+        {
+            "Action": [
+                "logs:GetLogEvents"
+            ],
+            "Resource": [
+                "arn:aws:logs:ap-northeast-2:${data.aws_caller_identity.current.account_id}:log-group:/aws/codebuild/*:*"
+            ],
+            "Effect": "Allow"
+        },
         {
             "Action": [
                 "codedeploy:Get*"
@@ -80,7 +90,13 @@ module "lambda_function" {
             "Action": [
                 "dynamodb:*"
             ],
-            "Resource": "arn:aws:dynamodb:ap-northeast-2:${data.aws_caller_identity.current.account_id}:table/codepipeline-slack-integration",
+            "Resource": [
+                "arn:aws:dynamodb:ap-northeast-2:${data.aws_caller_identity.current.account_id}:table/codepipeline-slack-integration",
+                "arn:aws:dynamodb:ap-northeast-2:${data.aws_caller_identity.current.account_id}:table/codepipeline-slack-executions",
+                "arn:aws:dynamodb:ap-northeast-2:${data.aws_caller_identity.current.account_id}:table/codepipeline-slack-cache",
+                "arn:aws:dynamodb:ap-northeast-2:${data.aws_caller_identity.current.account_id}:table/codepipeline-slack-alarms",
+                "arn:aws:dynamodb:ap-northeast-2:${data.aws_caller_identity.current.account_id}:table/codepipeline-slack-runs"
+            ],
             "Effect": "Allow"
         },
         {
@@ -96,7 +112,8 @@ module "lambda_function" {
             "Action": [
                 "sqs:ReceiveMessage",
                 "sqs:DeleteMessage",
-                "sqs:GetQueueAttributes"
+                "sqs:GetQueueAttributes",
+                "sqs:SendMessage"
             ],
             "Resource": [
                 "arn:aws:sqs:ap-northeast-2:${data.aws_caller_identity.current.account_id}:codepipeline-slack-queue"
@@ -114,7 +131,7 @@ EOF
     }
   }
 
-  reserved_concurrent_executions = 1
+  reserved_concurrent_executions = 10
   memory_size = 256
   timeout = 30
 
@@ -126,6 +143,69 @@ EOF
 resource "aws_lambda_event_source_mapping" "default" {
   event_source_arn = aws_sqs_queue.codepipeline_slack_queue.arn
   function_name    = module.lambda_function.lambda_function_arn
-  batch_size = 1
+  batch_size = 10
+  maximum_batching_window_in_seconds = 5
+  function_response_types = ["ReportBatchItemFailures"]
   enabled = true
-}
\ No newline at end of file
+}
+
+module "digest_function" {
+  source = "terraform-aws-modules/lambda/aws"
+  version = "2.7.0"
+
+  function_name = "codepipeline-slack-digest"
+  description   = "periodic digest of codepipeline runs to slack"
+  handler       = "digest.run"
+  runtime       = "python3.7"
+  publish       = true
+
+  source_path = [
+    {
+      path             = "../../src/"
+    }
+  ]
+
+  store_on_s3 = true
+  s3_bucket   = aws_s3_bucket.default.id
+
+  environment_variables = { for tuple in regexall("(.*)=(.*)", file(".env")) : tuple[0] => tuple[1] }
+
+  attach_policy_json = true
+  policy_json = <<EOF
+{
+    "Version": "2012-10-17",
+    "Statement": [
+        {
+            "Action": [
+                "codepipeline:List*"
+            ],
+            "Resource": "*",
+            "Effect": "Allow"
+        },
+        {
+            "Action": [
+                "dynamodb:Query"
+            ],
+            "Resource": [
+                "arn:aws:dynamodb:ap-northeast-2:${data.aws_caller_identity.current.account_id}:table/codepipeline-slack-runs"
+            ],
+            "Effect": "Allow"
+        }
+    ]
+}
+EOF
+
+  allowed_triggers = {
+    DigestSchedule = {
+      principal = "events.amazonaws.com",
+      source_arn = aws_cloudwatch_event_rule.digest_schedule_rule.arn
+    }
+  }
+
+  memory_size = 256
+  timeout = 300
+
+  tags = {
+    monitor = "false"
+  }
+}
@@ -14,3 +14,97 @@ resource "aws_dynamodb_table" "default" {
     Name = "codepipeline-slack-integration"
   }
 }
+
+resource "aws_dynamodb_table" "executions" {
+  name           = "codepipeline-slack-executions"
+  billing_mode   = "PROVISIONED"
+  read_capacity  = 5
+  write_capacity = 5
+  hash_key       = "pipeline_execution_id"
+
+  attribute {
+    name = "pipeline_execution_id"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+
+  tags = {
+    Name = "codepipeline-slack-executions"
+  }
+}
+
+resource "aws_dynamodb_table" "cache" {
+  name           = "codepipeline-slack-cache"
+  billing_mode   = "PROVISIONED"
+  read_capacity  = 5
+  write_capacity = 5
+  hash_key       = "cache_key"
+
+  attribute {
+    name = "cache_key"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+
+  tags = {
+    Name = "codepipeline-slack-cache"
+  }
+}
+
+resource "aws_dynamodb_table" "alarms" {
+  name           = "codepipeline-slack-alarms"
+  billing_mode   = "PROVISIONED"
+  read_capacity  = 5
+  write_capacity = 5
+  hash_key       = "alarm_key"
+
+  attribute {
+    name = "alarm_key"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+
+  tags = {
+    Name = "codepipeline-slack-alarms"
+  }
+}
+
+resource "aws_dynamodb_table" "runs" {
+  name           = "codepipeline-slack-runs"
+  billing_mode   = "PROVISIONED"
+  read_capacity  = 5
+  write_capacity = 5
+  hash_key       = "pipeline_name"
+  range_key      = "sk"
+
+  attribute {
+    name = "pipeline_name"
+    type = "S"
+  }
+
+  attribute {
+    name = "sk"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+
+  tags = {
+    Name = "codepipeline-slack-runs"
+  }
+}
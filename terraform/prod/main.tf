@@ -9,7 +9,7 @@ terraform {
   }
   required_version = ">= 0.14.8"
   required_providers {
-    aws = ">= 3.32.0"
+    aws = ">= 3.63.0"
   }
 }
 
@@ -239,6 +239,26 @@ resource "aws_cloudwatch_event_rule" "codedeploy_event_rule" {
 EOF
 }
 
+resource "aws_cloudwatch_event_rule" "ecs_task_event_rule" {
+  name = "ecs_task_event_rule"
+
+  event_pattern = <<EOF
+{
+  "source": [
+    "aws.ecs"
+  ],
+  "detail-type": [
+    "ECS Task State Change"
+  ],
+  "detail": {
+    "lastStatus": [
+      "STOPPED"
+    ]
+  }
+}
+EOF
+}
+
 resource "aws_cloudwatch_event_target" "codepipeline_event_target" {
   rule      = aws_cloudwatch_event_rule.codepipeline_event_rule.name
   target_id = "codepipeline_event_target"
@@ -250,3 +270,22 @@ resource "aws_cloudwatch_event_target" "codedeploy_event_target" {
   target_id = "codedeploy_event_target"
   arn       = aws_sns_topic.codepipeline_events_sns.arn
 }
+
+resource "aws_cloudwatch_event_target" "ecs_task_event_target" {
+  rule      = aws_cloudwatch_event_rule.ecs_task_event_rule.name
+  target_id = "ecs_task_event_target"
+  arn       = aws_sns_topic.codepipeline_events_sns.arn
+}
+
+# every day at 09:00 KST
+resource "aws_cloudwatch_event_rule" "digest_schedule_rule" {
+  name                = "digest_schedule_rule"
+  schedule_expression = "cron(0 0 * * ? *)"
+}
+
+resource "aws_cloudwatch_event_target" "digest_schedule_target" {
+  rule      = aws_cloudwatch_event_rule.digest_schedule_rule.name
+  target_id = "digest_schedule_target"
+  arn       = module.digest_function.lambda_function_arn
+  input     = jsonencode({ period_hours = 24 })
+}
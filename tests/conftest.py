@@ -0,0 +1,83 @@
+import os
+import sys
+
+import pytest
+
+SRC_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+DYNAMODB_TABLES = {
+    'DYNAMODB_TABLE': ('codepipeline-slack-integration', 'deployment_id'),
+    'DYNAMODB_EXECUTION_TABLE': ('codepipeline-slack-executions', 'pipeline_execution_id'),
+    'DYNAMODB_CACHE_TABLE': ('codepipeline-slack-cache', 'cache_key'),
+    'DYNAMODB_ALARM_TABLE': ('codepipeline-slack-alarms', 'alarm_key'),
+    'DYNAMODB_RUN_TABLE': ('codepipeline-slack-runs', 'pipeline_name', 'sk'),
+}
+
+# the modules read their configuration when they are imported
+os.environ.update({
+    'AWS_DEFAULT_REGION': 'ap-northeast-2',
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'SLACK_BOT_TOKEN': 'xoxb-test',
+    'SLACK_CHANNEL': 'test',
+})
+for variable, (table_name, *_) in DYNAMODB_TABLES.items():
+    os.environ[variable] = table_name
+sys.path.insert(0, SRC_DIR)
+
+
+@pytest.fixture(autouse=True)
+def aws():
+    from moto import mock_aws
+    from lazy import LazyObject
+    import dynamodb_helper
+    import aws_client
+
+    with mock_aws():
+        # clients and tables of an earlier test belong to its mock
+        for module in (dynamodb_helper, aws_client):
+            for value in vars(module).values():
+                if isinstance(value, LazyObject):
+                    value._target = None
+
+        import boto3
+        dynamodb = boto3.client('dynamodb')
+        for table_name, *keys in DYNAMODB_TABLES.values():
+            dynamodb.create_table(
+                TableName=table_name,
+                KeySchema=[{'AttributeName': key, 'KeyType': key_type} for key, key_type in zip(keys, ('HASH', 'RANGE'))],
+                AttributeDefinitions=[{'AttributeName': key, 'AttributeType': 'S'} for key in keys],
+                BillingMode='PAY_PER_REQUEST',
+            )
+        yield
+
+
+@pytest.fixture
+def slack(monkeypatch):
+    # the slack calls made by message_builder, channel names stand in for channel ids
+    import message_builder
+
+    class FakeSlack:
+        def __init__(self):
+            self.posted = []
+            self.updated = []
+            self.deleted = []
+
+        def send_message(self, channel_id, attachments):
+            ts = f'{len(self.posted) + 1}.000000'
+            self.posted.append((channel_id, ts))
+            return {'ok': True, 'ts': ts}
+
+        def update_message(self, channel_id, message_ts, attachments):
+            self.updated.append((channel_id, message_ts))
+            return {'ok': True}
+
+        def delete_message(self, channel_id, message_ts):
+            self.deleted.append((channel_id, message_ts))
+            return {'ok': True}
+
+    fake = FakeSlack()
+    monkeypatch.setattr(message_builder, 'send_message', fake.send_message)
+    monkeypatch.setattr(message_builder, 'update_message', fake.update_message)
+    monkeypatch.setattr(message_builder, 'delete_message', fake.delete_message)
+    monkeypatch.setattr(message_builder, 'find_channel_id', lambda channel: channel)
+    return fake
@@ -0,0 +1,63 @@
+import pytest
+
+import ecs_alarm
+from dynamodb_helper import find_alarm, record_task_stop
+from event_parser import EcsTaskEvent
+
+ALARM_KEY = 'cluster#service:api#reason'
+
+
+def task_stop(task_id):
+    return EcsTaskEvent(
+        f'event-{task_id}', '2022-03-14T09:00:00Z', 'cluster', 'service:api', task_id, 'api:12',
+        'Essential container in task exited', (('api', 'exit code 1'),),
+    )
+
+
+def record(task_id):
+    return record_task_stop(ALARM_KEY, {'task_id': task_id}, window_seconds=600, ttl_seconds=3600)
+
+
+@pytest.fixture
+def slack(monkeypatch):
+    posted = []
+
+    def send_message(channel_id, attachments):
+        posted.append(channel_id)
+        return {'ok': True, 'ts': f'{len(posted)}.000000'}
+
+    monkeypatch.setattr(ecs_alarm, 'send_message', send_message)
+    monkeypatch.setattr(ecs_alarm, 'update_message', lambda channel_id, message_ts, attachments: {'ok': True})
+    monkeypatch.setattr(ecs_alarm, 'delete_message', lambda channel_id, message_ts: {'ok': True})
+    monkeypatch.setattr(ecs_alarm, 'find_channel_id', lambda channel: channel)
+    monkeypatch.setattr(ecs_alarm, 'ECS_ALARM_UPDATE_SECONDS', 0)
+    return posted
+
+
+def test_a_redelivered_task_stop_is_counted_once():
+    item, opened = record('task-0')
+    assert opened
+    record('task-1')
+
+    item, opened = record('task-0')
+
+    assert not opened
+    assert item['stop_count'] == 2
+    assert item['recent_tasks'] == ['task-1', 'task-0']
+
+
+def test_a_window_whose_post_failed_is_posted_by_the_redelivered_stop(slack, monkeypatch):
+    def failing_send_message(channel_id, attachments):
+        raise RuntimeError('slack failed')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(ecs_alarm, 'send_message', failing_send_message)
+        with pytest.raises(RuntimeError):
+            ecs_alarm.alarm_task(task_stop('task-0'))
+
+    ecs_alarm.alarm_task(task_stop('task-0'))
+
+    alarm = find_alarm(ecs_alarm.create_alarm_key(task_stop('task-0')))
+    assert slack == ['test']
+    assert alarm['messages'] == {'test': '1.000000'}
+    assert alarm['stop_count'] == 1
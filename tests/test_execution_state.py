@@ -0,0 +1,87 @@
+import pytest
+
+from dynamodb_helper import (
+    ConflictError,
+    claim_message,
+    claim_render,
+    find_execution,
+    save_execution,
+)
+from message_builder import MessageBuilder, save_state, send_new_message
+
+EXECUTION_ID = 'execution-1'
+PIPELINE_NAME = 'sample-service'
+
+
+def load_builder():
+    return MessageBuilder(find_execution(EXECUTION_ID), EXECUTION_ID, PIPELINE_NAME)
+
+
+def test_save_execution_rejects_a_stale_version():
+    state = MessageBuilder.create_state()
+    assert save_execution(EXECUTION_ID, pipeline_name=PIPELINE_NAME, state=state, version=0) == 1
+    assert save_execution(EXECUTION_ID, pipeline_name=PIPELINE_NAME, state=state, version=1) == 2
+
+    with pytest.raises(ConflictError):
+        save_execution(EXECUTION_ID, pipeline_name=PIPELINE_NAME, state=state, version=1)
+
+
+def test_save_state_replays_changes_on_a_concurrently_saved_state():
+    first, second = load_builder(), load_builder()
+    first.update_deploy_task_definition('sample-service:41')
+    second.attach_build_log('Build', 'error: tests failed')
+
+    save_state(first)
+    save_state(second)
+
+    item = find_execution(EXECUTION_ID)
+    assert item['version'] == 2
+    assert second.version == 2
+    assert item['state']['task_def'] == 'sample-service:41'
+    assert item['state']['build_logs'] == {'Build': 'error: tests failed'}
+
+
+def test_a_change_that_raises_is_not_recorded():
+    builder = load_builder()
+    with pytest.raises(TypeError):
+        builder.attach_revision_info(None)
+
+    assert builder.changes == []
+
+
+def test_claim_message_keeps_the_first_post():
+    save_execution(EXECUTION_ID, pipeline_name=PIPELINE_NAME, state=MessageBuilder.create_state(), version=0)
+
+    assert claim_message(EXECUTION_ID, 'C1', '1.000000')
+    assert not claim_message(EXECUTION_ID, 'C1', '2.000000')
+    assert find_execution(EXECUTION_ID)['messages'] == {'C1': '1.000000'}
+
+
+def test_duplicate_post_is_deleted_and_the_kept_message_updated(slack):
+    save_execution(EXECUTION_ID, pipeline_name=PIPELINE_NAME, state=MessageBuilder.create_state(), version=0)
+    builder = load_builder()
+    rendered = claim_render(EXECUTION_ID, builder.version)
+    # another invocation posted first
+    claim_message(EXECUTION_ID, 'C1', '0.000001')
+
+    send_new_message(builder, 'C1', rendered, builder.build_message())
+
+    assert slack.deleted == [('C1', '1.000000')]
+    assert builder.messages == {'C1': '0.000001'}
+    assert slack.updated == [('C1', '0.000001')]
+
+
+def test_duplicate_post_never_overwrites_a_newer_render(slack):
+    save_execution(EXECUTION_ID, pipeline_name=PIPELINE_NAME, state=MessageBuilder.create_state(), version=0)
+    builder = load_builder()
+    rendered = claim_render(EXECUTION_ID, builder.version)
+    # a newer version claimed the render and posted while this invocation was posting
+    save_execution(EXECUTION_ID, pipeline_name=PIPELINE_NAME, state=MessageBuilder.create_state(), version=1)
+    assert claim_render(EXECUTION_ID, 2)
+    claim_message(EXECUTION_ID, 'C1', '0.000001')
+
+    send_new_message(builder, 'C1', rendered, builder.build_message())
+
+    assert slack.deleted == [('C1', '1.000000')]
+    assert builder.messages == {'C1': '0.000001'}
+    assert slack.updated == []
@@ -0,0 +1,129 @@
+import json
+
+import pytest
+
+import notifier
+from event_parser import PipelineEvent
+
+
+def pipeline_record(message_id, execution_id, state, message_group_id=None):
+    event = {
+        'id': f'event-{message_id}',
+        'source': 'aws.codepipeline',
+        'detail-type': 'CodePipeline Pipeline Execution State Change',
+        'time': '2022-03-14T09:00:00Z',
+        'detail': {'execution-id': execution_id, 'pipeline': 'sample-service', 'state': state},
+    }
+    attributes = {'MessageGroupId': message_group_id} if message_group_id else {}
+    return {
+        'messageId': message_id,
+        'body': json.dumps({'Type': 'Notification', 'Message': json.dumps(event)}),
+        'attributes': attributes,
+    }
+
+
+def failures(result):
+    return [failure['itemIdentifier'] for failure in result['batchItemFailures']]
+
+
+@pytest.fixture
+def handled(monkeypatch):
+    # every event changes the execution, and a FAILED one raises after its change
+    handled = []
+
+    def process_pipeline(event, batch):
+        handled.append(event.id)
+        message_builder = notifier.get_message_builder(batch, event.pipeline_execution_id, event.pipeline_name)
+        message_builder.update_deploy_task_definition(event.id)
+        if event.state == 'FAILED':
+            raise RuntimeError('handler failed')
+        return message_builder
+
+    monkeypatch.setitem(notifier.HANDLERS, PipelineEvent, process_pipeline)
+    return handled
+
+
+@pytest.fixture
+def posted(monkeypatch):
+    posted = dict()
+
+    def post_message(message_builder, event_sources=()):
+        posted[message_builder.pipeline_execution_id] = (
+            message_builder.state['task_def'], len(message_builder.changes)
+        )
+        return True
+
+    monkeypatch.setattr(notifier, 'post_message', post_message)
+    return posted
+
+
+def test_only_failed_records_are_returned(handled, posted):
+    result = notifier.run({'Records': [
+        pipeline_record('m1', 'execution-a', 'STARTED'),
+        pipeline_record('m2', 'execution-a', 'FAILED'),
+        {'messageId': 'm3', 'body': 'not json', 'attributes': {}},
+        pipeline_record('m4', 'execution-b', 'STARTED'),
+    ]}, None)
+
+    assert failures(result) == ['m2', 'm3']
+    # the change of the failed record is undone on the builder posted for the rest of its execution
+    assert posted == {'execution-a': ('event-m1', 1), 'execution-b': ('event-m4', 1)}
+
+
+def test_a_failed_post_returns_every_record_of_its_execution(handled, monkeypatch):
+    def post_message(message_builder, event_sources=()):
+        if message_builder.pipeline_execution_id == 'execution-a':
+            raise RuntimeError('slack failed')
+        return True
+
+    monkeypatch.setattr(notifier, 'post_message', post_message)
+    result = notifier.run({'Records': [
+        pipeline_record('m1', 'execution-a', 'STARTED'),
+        pipeline_record('m2', 'execution-b', 'STARTED'),
+        pipeline_record('m3', 'execution-a', 'SUCCEEDED'),
+    ]}, None)
+
+    assert failures(result) == ['m1', 'm3']
+
+
+def test_fifo_group_stops_at_its_first_failure(handled, posted, monkeypatch):
+    monkeypatch.setattr(notifier, 'SQS_FIFO_MODE', True)
+    result = notifier.run({'Records': [
+        pipeline_record('m1', 'execution-a', 'FAILED', message_group_id='execution-a'),
+        pipeline_record('m2', 'execution-b', 'STARTED', message_group_id='execution-b'),
+        pipeline_record('m3', 'execution-a', 'SUCCEEDED', message_group_id='execution-a'),
+    ]}, None)
+
+    assert failures(result) == ['m1', 'm3']
+    # the rest of the group is not processed, so it is retried in order
+    assert handled == ['event-m1', 'event-m2']
+    assert posted == {'execution-b': ('event-m2', 1)}
+
+
+def test_fifo_group_is_retried_after_a_failed_post(handled, monkeypatch):
+    monkeypatch.setattr(notifier, 'SQS_FIFO_MODE', True)
+
+    def post_message(message_builder, event_sources=()):
+        if message_builder.pipeline_execution_id == 'execution-a':
+            raise RuntimeError('slack failed')
+        return True
+
+    monkeypatch.setattr(notifier, 'post_message', post_message)
+    result = notifier.run({'Records': [
+        pipeline_record('m1', 'execution-a', 'STARTED', message_group_id='group'),
+        pipeline_record('m2', 'execution-b', 'STARTED', message_group_id='group'),
+        pipeline_record('m3', 'execution-c', 'STARTED', message_group_id='other'),
+    ]}, None)
+
+    # m2 was posted, but it is after m1 in their group
+    assert failures(result) == ['m1', 'm2']
+
+
+def test_without_fifo_mode_records_after_a_failure_are_processed(handled, posted):
+    result = notifier.run({'Records': [
+        pipeline_record('m1', 'execution-a', 'FAILED', message_group_id='execution-a'),
+        pipeline_record('m2', 'execution-a', 'SUCCEEDED', message_group_id='execution-a'),
+    ]}, None)
+
+    assert failures(result) == ['m1']
+    assert posted == {'execution-a': ('event-m2', 1)}